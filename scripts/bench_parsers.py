@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+'''
+Compares the parse time of the HTML parser backends on saved pages, and
+checks that every backend extracts the same data as html5lib.
+
+e.g. python3 bench_parsers.py --incident fixtures/incident/* --listing fixtures/query/*
+     python3 bench_parsers.py --cache-dir .http_cache --sample 200
+'''
+
+import gzip
+import os
+import random
+import statistics
+from argparse import ArgumentParser
+from glob import glob
+from time import perf_counter
+
+import html_parsing
+from d_stage2 import IncidentContext, parse_incident
+from stage1_serializer import read_listing
+
+REFERENCE_BACKEND = 'html5lib'
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--incident',
+        metavar='FILE',
+        help="saved incident pages",
+        nargs='*',
+        default=[],
+    )
+    parser.add_argument(
+        '--listing',
+        metavar='FILE',
+        help="saved result pages of the stage 1 queries",
+        nargs='*',
+        default=[],
+    )
+    parser.add_argument(
+        '--cache-dir',
+        help="also use the incident pages of this http_cache directory",
+    )
+    parser.add_argument(
+        '--sample',
+        help="number of pages picked at random from --cache-dir (default: 100)",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        '--repeat',
+        help="parses of each page, the fastest one is kept (default: 3)",
+        type=int,
+        default=3,
+    )
+    return parser.parse_args()
+
+
+def read_page(fname):
+    if fname.endswith('.gz'):
+        with gzip.open(fname, 'rt', encoding='utf-8') as f:
+            return f.read()
+    with open(fname, encoding='utf-8') as f:
+        return f.read()
+
+
+def cached_incident_pages(cache_dir, sample):
+    fnames = glob(os.path.join(cache_dir, '*', '*.html.gz'))
+    fnames = random.sample(fnames, min(sample, len(fnames)))
+    # Result pages of stage 1 can be in the cache too.
+    return [fname for fname in fnames if 'View Incident' not in read_page(fname)]
+
+
+def time_parse(parse, pages, repeat):
+    '''
+    :returns: (parse times in seconds, parse results) of each page
+    '''
+    times, results = [], []
+    for html in pages:
+        best = None
+        for _ in range(repeat):
+            start = perf_counter()
+            result = parse(html)
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times.append(best)
+        results.append(result)
+    return times, results
+
+
+def bench(kind, parse_fn, pages, repeat):
+    print('{} {} page(s)'.format(len(pages), kind))
+    print('{:<12} {:>12} {:>12} {:>9} {:>6}'.format('backend', 'mean ms', 'median ms', 'speedup', 'same'))
+
+    reference_times, reference = time_parse(
+        lambda html: parse_fn(html, REFERENCE_BACKEND), pages, repeat)
+    for backend in html_parsing.BACKENDS:
+        if backend == REFERENCE_BACKEND:
+            times, results = reference_times, reference
+        else:
+            times, results = time_parse(lambda html: parse_fn(html, backend), pages, repeat)
+        print('{:<12} {:>12.2f} {:>12.2f} {:>8.1f}x {:>6}'.format(
+            backend,
+            statistics.mean(times) * 1000,
+            statistics.median(times) * 1000,
+            sum(reference_times) / sum(times),
+            'yes' if results == reference else 'NO',
+        ))
+    print()
+
+
+def main():
+    args = parse_args()
+
+    incident_pages = [read_page(fname) for fname in args.incident]
+    if args.cache_dir:
+        incident_pages += [read_page(fname) for fname in cached_incident_pages(args.cache_dir, args.sample)]
+    listing_pages = [read_page(fname) for fname in args.listing]
+
+    context = IncidentContext(address='', city_or_county='', state='')
+    if incident_pages:
+        bench('incident', lambda html, backend: parse_incident(html, context, '', backend),
+              incident_pages, args.repeat)
+    if listing_pages:
+        bench('listing', read_listing, listing_pages, args.repeat)
+    if not incident_pages and not listing_pages:
+        print('No pages given')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,30 @@ Helper functions used to clean data
 
 import sys
 import re
+from functools import lru_cache
 
+# Every cleaning function is called once per row of large DataFrames, but the
+# names repeat heavily, so results are memoized per distinct input string.
+CACHE_SIZE = 2 ** 16
 
+NON_ALPHA = re.compile("[^a-z]")
+PARENTHETICAL_SUFFIX = re.compile(r'([\w\s-]+) (\([\w\s-]+\))')
+NEIGHBORHOOD = re.compile(r'^([\w\s\.]+) \(([\w\s\.]+)\)$')
+
+
+def normalize_series(s, fn):
+    '''
+    Applies a cleaning function to a pandas Series, calling it only once
+    per distinct value. Missing values are left as they are, and the result
+    always has object dtype, even for a categorical input.
+
+    :param fn: one argument cleaning function, e.g. standardized_state
+    '''
+    uniques = s.dropna().unique()
+    return s.map(dict(zip(uniques, map(fn, uniques)))).astype(object)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
 def strip_special(s: str) -> str:
     '''
     used to make all town, city, and county names
@@ -13,11 +35,30 @@ def strip_special(s: str) -> str:
     are easier to match with dirty data
     '''
     s = s.lower()
-    rex = re.compile(("[^a-z]"))
-    stripped = str(re.sub(rex, "", s))
+    stripped = str(NON_ALPHA.sub("", s))
     return stripped
 
 
+def strip_special_series(s):
+    '''
+    strip_special for a whole pandas Series of strings at once
+    '''
+    return s.str.lower().str.replace(NON_ALPHA, "", regex=True)
+
+
+# Certain cities will have their 'township' suffix removed for uniformity
+TOWNSHIPS_REMOVE_SUFFIX = ['redfordtownship']
+
+# Certain names will be manually overwritten (neighborhoods -> cities, etc.)
+CITY_EXCEPTIONS = {
+    'districtofcolumbia': 'washingtondc',
+    'statenisland': 'newyorkcity',
+    'coneyisland': 'newyorkcity',
+    'jointbaseelmendorfrichardson': 'anchorage',
+}
+
+
+@lru_cache(maxsize=CACHE_SIZE)
 def correct_city_name(city_name: str) -> str:
     '''
     Fix typos and replace special strings with their proper city names.
@@ -31,21 +72,11 @@ def correct_city_name(city_name: str) -> str:
     # Simplify charter townships to townships
     out = out.replace('chartertownship', 'township')
 
-    # Certain cities will have their 'township' suffix removed for uniformity
-    townships_remove_suffix = ['redfordtownship']
-    if out in townships_remove_suffix:
+    if out in TOWNSHIPS_REMOVE_SUFFIX:
         out = out[0:-len('township')]
 
-    # Certain names will be manually overwritten (neighborhoods -> cities, etc.)
-    exception_dict = {
-        'districtofcolumbia': 'washingtondc',
-        'statenisland': 'newyorkcity',
-        'coneyisland': 'newyorkcity',
-        'jointbaseelmendorfrichardson': 'anchorage',
-    }
-
-    if out in exception_dict.keys():
-        out = exception_dict[out]
+    if out in CITY_EXCEPTIONS:
+        out = CITY_EXCEPTIONS[out]
 
     return out
 
@@ -54,15 +85,23 @@ def correct_city_name(city_name: str) -> str:
 # Housing Dataset
 
 
-def clean_housing_city(s: str, col) -> str:
+# 'Town of' names that are kept as they are
+TOWN_OF_WHITELIST = ['townofpines']
+
+
+def clean_housing_city(s: str, col=None) -> str:
     '''
     Used to clean the RegionName into a usable city name.
     '''
+    return _clean_housing_city(s)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _clean_housing_city(s: str) -> str:
     out = strip_special(s)
 
     # Format 'Town of' instances
-    whitelist = ['townofpines']
-    if out.startswith('townof') and out not in whitelist:
+    if out.startswith('townof') and out not in TOWN_OF_WHITELIST:
         out = out[6:]
 
     return correct_city_name(out)
@@ -71,6 +110,12 @@ def clean_housing_city(s: str, col) -> str:
 # Population Dataset
 
 
+# If the suffix is one of these place designations, remove it.
+PLACE_DESIGNATIONS_CROP = ['cdp', 'government', 'village', 'urbana', 'gore', 'corporation', 'town',
+                           'plantation', 'city', 'grant', 'location', 'borough', 'comunidad', 'purchase', 'municipality']
+
+
+@lru_cache(maxsize=CACHE_SIZE)
 def clean_pop_city_county(s: str) -> str:
     '''
     Extracts the city name from a field in theh population dataset.
@@ -103,7 +148,7 @@ def clean_pop_city_county(s: str) -> str:
         raw_city = s.split(', ')[0]
 
     # Remove parenthetical suffix, if exists
-    match = re.compile(r'([\w\s-]+) (\([\w\s-]+\))').match(raw_city)
+    match = PARENTHETICAL_SUFFIX.match(raw_city)
     if match:
         # pass
         raw_city = match.group(1)
@@ -112,14 +157,10 @@ def clean_pop_city_county(s: str) -> str:
     suffix = strip_special(suffix)
     city = strip_special(raw_city)
 
-    # If the suffix is one of these place designations, remove it.
-    place_designations_crop = ['cdp', 'government', 'village', 'urbana', 'gore', 'corporation', 'town',
-                               'plantation', 'city', 'grant', 'location', 'borough', 'comunidad', 'purchase', 'municipality']
-
     out = city
     if suffix is 'county' or suffix is 'countypart':
         out = 'POPCOUNTYDATA'
-    elif suffix in place_designations_crop:
+    elif suffix in PLACE_DESIGNATIONS_CROP:
         out = city[:-len(suffix)]
 
     return correct_city_name(out)
@@ -151,6 +192,11 @@ def clean_pop_float(i) -> float:
 # GV Dataset
 
 
+# Names in the format "<neighborhood> (<city>)", where the city comes second
+ESPECIAL_CITIES = ["Manchester", "Chincoteague"]
+
+
+@lru_cache(maxsize=CACHE_SIZE)
 def clean_gv_city(s: str) -> str:
     '''
     Clean the city/county/borough data into a standardized city string.
@@ -163,13 +209,12 @@ def clean_gv_city(s: str) -> str:
     out = city
 
     # Match for strings in the format "<city> (<neighborhood>)".
-    neighborhood_match = re.compile(r'^([\w\s\.]+) \(([\w\s\.]+)\)$').match(s)
+    neighborhood_match = NEIGHBORHOOD.match(s)
     if neighborhood_match:
         left, right = neighborhood_match.groups()
 
         # Usually, LEFT is the city name, but there are exceptions.
-        especial_cities = ["Manchester", "Chincoteague"]
-        if right in especial_cities:
+        if right in ESPECIAL_CITIES:
             out = strip_special(right)
         else:
             out = strip_special(left)
@@ -177,71 +222,74 @@ def clean_gv_city(s: str) -> str:
     return correct_city_name(out)
 
 
+STATE_ABBREVIATIONS = {
+    "alabama": "al",
+    "alaska": "ak",
+    "arizona": "az",
+    "arkansas": "ar",
+    "california": "ca",
+    "colorado": "co",
+    "connecticut": "ct",
+    "delaware": "de",
+    "florida": "fl",
+    "georgia": "ga",
+    "hawaii": "hi",
+    "idaho": "id",
+    "illinois": "il",
+    "indiana": "in",
+    "iowa": "ia",
+    "kansas": "ks",
+    "kentucky": "ky",
+    "louisiana": "la",
+    "maine": "me",
+    "maryland": "md",
+    "massachusetts": "ma",
+    "michigan": "mi",
+    "minnesota": "mn",
+    "mississippi": "ms",
+    "missouri": "mo",
+    "montana": "mt",
+    "nebraska": "ne",
+    "nevada": "nv",
+    "newhampshire": "nh",
+    "newjersey": "nj",
+    "newmexico": "nm",
+    "newyork": "ny",
+    "northcarolina": "nc",
+    "northdakota": "nd",
+    "ohio": "oh",
+    "oklahoma": "ok",
+    "oregon": "or",
+    "pennsylvania": "pa",
+    "rhodeisland": "ri",
+    "southcarolina": "sc",
+    "southdakota": "sd",
+    "tennessee": "tn",
+    "texas": "tx",
+    "utah": "ut",
+    "vermont": "vt",
+    "virginia": "va",
+    "washington": "wa",
+    "westvirginia": "wv",
+    "wisconsin": "wi",
+    "wyoming": "wy",
+    "puertorico": "pr",
+    "districtofcolumbia": "dc",
+}
+
+
+@lru_cache(maxsize=CACHE_SIZE)
 def standardized_state(s: str) -> str:
     '''
     :param s: State name or its 2-letter postal code.
     :return: The state's 2-letter postal code.
     '''
     s = strip_special(s)
-    d = {
-        "alabama": "al",
-        "alaska": "ak",
-        "arizona": "az",
-        "arkansas": "ar",
-        "california": "ca",
-        "colorado": "co",
-        "connecticut": "ct",
-        "delaware": "de",
-        "florida": "fl",
-        "georgia": "ga",
-        "hawaii": "hi",
-        "idaho": "id",
-        "illinois": "il",
-        "indiana": "in",
-        "iowa": "ia",
-        "kansas": "ks",
-        "kentucky": "ky",
-        "louisiana": "la",
-        "maine": "me",
-        "maryland": "md",
-        "massachusetts": "ma",
-        "michigan": "mi",
-        "minnesota": "mn",
-        "mississippi": "ms",
-        "missouri": "mo",
-        "montana": "mt",
-        "nebraska": "ne",
-        "nevada": "nv",
-        "newhampshire": "nh",
-        "newjersey": "nj",
-        "newmexico": "nm",
-        "newyork": "ny",
-        "northcarolina": "nc",
-        "northdakota": "nd",
-        "ohio": "oh",
-        "oklahoma": "ok",
-        "oregon": "or",
-        "pennsylvania": "pa",
-        "rhodeisland": "ri",
-        "southcarolina": "sc",
-        "southdakota": "sd",
-        "tennessee": "tn",
-        "texas": "tx",
-        "utah": "ut",
-        "vermont": "vt",
-        "virginia": "va",
-        "washington": "wa",
-        "westvirginia": "wv",
-        "wisconsin": "wi",
-        "wyoming": "wy",
-        "puertorico": "pr",
-        "districtofcolumbia": "dc",
-    }
     if len(s) == 2:
         return s
     else:
         try:
-            abbr = d[s]
+            abbr = STATE_ABBREVIATIONS[s]
             return abbr
         except KeyError:
             return s
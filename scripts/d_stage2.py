@@ -2,34 +2,39 @@
 
 from argparse import ArgumentParser, Namespace
 import asyncio
-from collections import defaultdict, namedtuple
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import multiprocessing as mp
 from multiprocessing import Pool, cpu_count
+from multiprocessing.util import Finalize
+from math import ceil
 from typing import Dict, List, Optional, Tuple, Union, cast
+import os
 import re
 import sys
-from time import sleep, time
-from urllib.parse import parse_qs, urlparse
+from urllib.parse import parse_qs, urlparse, urlunparse
 
+import html_parsing
+import http_cache
 import selenium_utils
+import stage_io
+from http_cache import HttpCache
+from jobqueue import IN_FLIGHT, PENDING, JobQueue
+from metrics import INTERVAL as METRICS_INTERVAL, Metrics
+from scheduler import MAX_RETRIES, Scheduler
 
-import numpy as np
 import pandas as pd
+from aiohttp import ClientError, ClientSession, TCPConnector
 from bs4 import BeautifulSoup
 from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 # from selenium.webdriver import Chrome
 
 
-SCHEMA = {
-    'congressional_district': np.float64,
-    'state_house_district': np.float64,
-    'state_senate_district': np.float64,
-    'n_guns_involved': np.float64,
-}
-
 ALL_FIELD_NAMES = sorted([
     'latitude',
     'longitude',
@@ -60,6 +65,42 @@ ALL_FIELD_NAMES = sorted([
 
 DROPPED_FIELD_NAMES = ['participant_participant_characteristics']
 
+# Fields added to each input row, in the order of the output columns. The dropped fields are left out.
+OUTPUT_FIELD_NAMES = list(ALL_FIELD_NAMES)
+
+# Number of scraped rows between two writes to a worker's checkpoint file.
+FLUSH_EVERY = 100
+
+# Politeness budget: requests per second shared by all the workers, and the maximum number of
+# requests in flight at once with --http.
+RPS = 1.5
+HTTP_CONCURRENCY = 4
+
+# Errors worth retrying a page load for, besides 429/5xx responses.
+CHROME_RETRY_ON = (WebDriverException,)
+HTTP_RETRY_ON = (ClientError, asyncio.TimeoutError)
+
+# Number of incidents handed to a worker process at a time by --reparse.
+REPARSE_CHUNKSIZE = 500
+
+# Number of incidents claimed from the job queue at a time by a worker.
+QUEUE_CHUNKSIZE = 20
+
+# Number of incidents handed to a browser worker at a time.
+CHUNKSIZE = 10
+
+# Average seconds a browser takes to load an incident page, used to pick the number of browsers
+# that the request budget keeps busy.
+PAGE_LOAD_SECONDS = 3
+
+# State of a browser worker of the pool, set by _init_worker.
+_worker_scheduler = None
+_worker_options = None
+_worker_cache = None
+_worker_parser = html_parsing.DEFAULT_BACKEND
+_worker_browser = None
+_worker_metrics = None
+
 # —————
 # Utility functions
 
@@ -73,6 +114,65 @@ def chunks(n, lst):
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
+
+def checkpoint_fname(output_fname: str, idx: int) -> str:
+    return '{}.part{}.csv'.format(output_fname, idx)
+
+
+def remove_checkpoints(output_fname: str, n_workers: int) -> None:
+    """Removes the checkpoints of the workers once the output is complete."""
+    for idx in range(n_workers):
+        if os.path.exists(checkpoint_fname(output_fname, idx)):
+            os.remove(checkpoint_fname(output_fname, idx))
+
+
+class RecordBuffer(object):
+    """
+    Collects scraped rows as plain tuples and builds a DataFrame from them only once, instead of
+    growing a DataFrame one row at a time.
+
+    With a checkpoint file, the rows are also appended to it every `flush_every` rows, and rows
+    left in it by a previous (crashed) run are loaded back, so that they are not scraped again.
+    """
+
+    def __init__(self, columns, checkpoint_fname=None, flush_every=FLUSH_EVERY):
+        self.columns = list(columns)
+        self._checkpoint_fname = checkpoint_fname
+        self._flush_every = flush_every
+        self._records = []
+        self._n_flushed = 0
+
+    def load_checkpoint(self) -> set:
+        """
+        :returns: the URLs of the incidents found in the checkpoint file
+        """
+        if self._checkpoint_fname is None or not os.path.exists(self._checkpoint_fname):
+            return set()
+
+        df = stage_io.read_stage(self._checkpoint_fname).reindex(columns=self.columns)
+        self._records.extend(df.itertuples(index=False, name=None))
+        self._n_flushed = len(self._records)
+        return set(df['incident_url'])
+
+    def add(self, record: tuple) -> None:
+        self._records.append(record)
+        if self._checkpoint_fname is not None and \
+                len(self._records) - self._n_flushed >= self._flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._checkpoint_fname is None or self._n_flushed == len(self._records):
+            return
+
+        pending = self._records[self._n_flushed:]
+        append = os.path.exists(self._checkpoint_fname)
+        with stage_io.StageWriter(self._checkpoint_fname, append=append) as writer:
+            writer.write(pd.DataFrame(pending, columns=self.columns))
+        self._n_flushed = len(self._records)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self._records, columns=self.columns)
+
 # —————
 
 
@@ -84,12 +184,12 @@ def parse_args() -> Namespace:
     parser.add_argument(
         'input_fname',
         metavar='INPUT',
-        help='Path to input file.',
+        help='Path to input file (.csv, .parquet or .feather).',
     )
     parser.add_argument(
         'output_fname',
         metavar='OUTPUT',
-        help='Path to output file.',
+        help='Path to output file (.csv, .parquet or .feather).',
     )
 
     # Optional args
@@ -100,27 +200,125 @@ def parse_args() -> Namespace:
         action='store_true',
         dest='should_use_headless',
     )
+    parser.add_argument(
+        '--flush-every',
+        help='With --http, number of incidents scraped between two saves of the progress to '
+             '<output>.part0.csv (default: {}). Without --http, every finished --chunksize '
+             'chunk is saved there instead'.format(FLUSH_EVERY),
+        type=int,
+        default=FLUSH_EVERY,
+    )
+    parser.add_argument(
+        '--limit',
+        help='Only scrape the first LIMIT incidents of the input',
+        type=int,
+    )
+    parser.add_argument(
+        '--queue',
+        metavar='QUEUE',
+        help='Track the incidents in this SQLite job queue, so that the run can be resumed after '
+             'a crash, and shared by several processes',
+        dest='queue_fname',
+    )
+    parser.add_argument(
+        '--retry-failed',
+        help='With --queue, try the incidents that failed in earlier runs again',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        help='Directory of the cache of downloaded pages (default: {})'.format(http_cache.CACHE_DIR),
+        default=http_cache.CACHE_DIR,
+    )
+    parser.add_argument(
+        '--cache-size',
+        help='Size cap of the cache in MB (default: {})'.format(http_cache.MAX_BYTES // 1024 ** 2),
+        type=int,
+        default=http_cache.MAX_BYTES // 1024 ** 2,
+    )
+    parser.add_argument(
+        '--no-cache',
+        help='Always download the pages, and do not store them in the cache',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--parser',
+        help='HTML parser backend (default: {})'.format(html_parsing.DEFAULT_BACKEND),
+        choices=html_parsing.BACKENDS,
+        default=html_parsing.DEFAULT_BACKEND,
+    )
+    parser.add_argument(
+        '--reparse',
+        help='Parse the pages in the cache only, without any request',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--workers',
+        help='Number of browsers, or of processes with --reparse (default: as many browsers as '
+             '--rps keeps busy, up to one per core, or one process per core)',
+        type=int,
+    )
+    parser.add_argument(
+        '--chunksize',
+        help='Number of incidents handed to a browser at a time (default: {})'.format(CHUNKSIZE),
+        type=int,
+        default=CHUNKSIZE,
+    )
+    parser.add_argument(
+        '--http',
+        help='Download the incident pages with plain HTTP requests instead of Chrome',
+        action='store_true',
+        dest='use_http',
+    )
+    parser.add_argument(
+        '--rps',
+        help='Requests per second shared by all workers, 0 for no limit. Lowered automatically '
+             'on 429/5xx responses (default: {})'.format(RPS),
+        type=float,
+        default=RPS,
+    )
+    parser.add_argument(
+        '--max-retries',
+        help='Retries of a failed page load before requeueing it (default: {})'.format(
+            MAX_RETRIES),
+        type=int,
+        default=MAX_RETRIES,
+    )
+    parser.add_argument(
+        '--concurrency',
+        help='With --http, maximum number of requests in flight (default: {})'.format(
+            HTTP_CONCURRENCY),
+        type=int,
+        default=HTTP_CONCURRENCY,
+    )
+    parser.add_argument(
+        '--base-url',
+        help='With --http, request the incident pages from this server instead, '
+             'e.g. http://localhost:8000',
+    )
+    parser.add_argument(
+        '--metrics',
+        metavar='FILE',
+        help='Append the progress metrics (JSON lines) to this file instead of printing them',
+        dest='metrics_fname',
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        help='Seconds between two progress lines (default: {})'.format(METRICS_INTERVAL),
+        type=float,
+        default=METRICS_INTERVAL,
+    )
 
     args = parser.parse_args()
     return args
 
 
 def load_input(args):
-    return pd.read_csv(
-        args.input_fname,
-        dtype=SCHEMA,
-        parse_dates=['date'],
-        encoding='utf-8',
-    )
+    return stage_io.read_stage(args.input_fname)
 
 
 def write_output(args, df) -> None:
-    df.to_csv(
-        args.output_fname,
-        index=False,
-        float_format='%g',
-        encoding='utf-8',
-    )
+    stage_io.write_stage(df, args.output_fname)
 
 
 def _supplement_next_url(next_url: str, current_url: str) -> str:
@@ -314,128 +512,613 @@ class Scraper(object):
         return _stringify_list([a['href'] for a in anchors])
 
 
-def scrape_incidents(df, chrome_options, thread_idx=0):
+def parse_incident(html: str, context: IncidentContext, url: str,
+                   parser=html_parsing.DEFAULT_BACKEND, metrics=None) -> Dict[str, Optional[str]]:
+    """
+    Extracts the fields of an incident page, using the given html_parsing backend.
+
+    Returns a dict from field name to value, with a None value for every missing field.
+
+    The time spent parsing, extracting and normalizing is added to the timers of metrics.
+    """
+    metrics = metrics or Metrics()
+    with metrics.timer('parse'):
+        soup = html_parsing.make_soup(html, parser, only_id='block-system-main')
+    block_system_main = soup.find(id='block-system-main')
+    if block_system_main is None:
+        raise ValueError('No incident data found in the page of {}'.format(url))
+
+    def find_content_div(title):
+        h2 = block_system_main.find('h2', string=title)
+        return h2.parent if h2 else None
+
+    with metrics.timer('extract'):
+        location_fields = Scraper.extract_location_fields(find_content_div('Location'), context)
+        participant_fields = Scraper.extract_participant_fields(
+            find_content_div('Participants'))
+        guns_involved_fields = Scraper.extract_guns_involved_fields(
+            find_content_div('Guns Involved')
+        )
+        district_fields = Scraper.extract_district_fields(
+            find_content_div('District')
+        )
+
+        incident_characteristics = Scraper.extract_incident_characteristics(
+            find_content_div('Incident Characteristics')
+        )
+        notes = Scraper.extract_notes(find_content_div('Notes'))
+        sources = Scraper.extract_sources(find_content_div('Sources'))
+
+    all_fields = [
+        *location_fields,
+        *participant_fields,
+        *guns_involved_fields,
+        *district_fields,
+        Field('incident_characteristics', incident_characteristics),
+        Field('notes', notes),
+        Field('sources', sources),
+    ]
+
+    with metrics.timer('normalize'):
+        return dict(_normalize(all_fields, url))
+
+
+def _incident_record(row: tuple, fields: Dict[str, Optional[str]]) -> tuple:
+    return (*row, *(fields.get(name) for name in OUTPUT_FIELD_NAMES))
+
+
+def _incident_context(row) -> IncidentContext:
+    return IncidentContext(
+        address=row.address,
+        city_or_county=row.city_or_county,
+        state=row.state,
+    )
+
+
+def _load_incident_page(browser, url: str) -> str:
+    browser.get(url)
+    # Wait until the page contains meaningful data.
+    browser.find_element_or_wait(By.ID, 'block-system-main')
+    return browser.page_source
+
+
+def scrape_incidents(df, chrome_options, thread_idx=0, checkpoint_fname=None, flush_every=FLUSH_EVERY,
+                     scheduler=None, cache=None, parser=html_parsing.DEFAULT_BACKEND, get_browser=None,
+                     metrics=None):
     """
     Cracks open a new Chrome browser to extract incident data based on the URL in every field in 
     the dataframe.
-    """
-    browser = webdriver.Chrome(options=chrome_options)
 
-    new_df = pd.DataFrame([], columns=[*df.columns, *ALL_FIELD_NAMES])
-    # print(new_df)
-    print('Starting new browser')
+    If checkpoint_fname is given, scraped rows are saved to it every flush_every rows, and
+    incidents already saved there by a previous run are skipped.
 
-    sleep(thread_idx * 3)
+    Page loads are paced and retried by the scheduler, which defaults to the one shared by the
+    workers of the pool. An incident that still fails is retried once more after the rest of the
+    dataframe, then skipped. Incidents whose page cannot be parsed are skipped.
 
-    for counter, i in enumerate(df.index.values):
-        sleep(3)
-        print(i)
-        # Unpack the row.
-        row = df.loc[i]
-        context = IncidentContext(
-            address=row['address'],
-            city_or_county=row['city_or_county'],
-            state=row['state'],
-        )
+    With a cache, pages found in it are not loaded again, and loaded pages are added to it.
+
+    get_browser can return a browser that outlives the call. By default a browser is started for
+    the call, and quit at the end.
+
+    Timings, page and incident counts and errors are recorded in metrics.
+    """
+    scheduler = scheduler or _worker_scheduler or Scheduler(RPS, retry_on=CHROME_RETRY_ON)
+    metrics = metrics or Metrics()
+    records = RecordBuffer([*df.columns, *OUTPUT_FIELD_NAMES], checkpoint_fname, flush_every)
+    done_urls = records.load_checkpoint()
+    df = df[~df['incident_url'].isin(done_urls)]
+    if len(df) == 0:
+        return records.to_frame()
+
+    browser = None
+    queue = deque(zip(df.index.values, df.itertuples(index=False)))
+    requeued = set()
+    while queue:
+        i, row = queue.popleft()
+        metrics.set_queue_depth(len(queue))
+
+        html = cache.get(row.incident_url) if cache is not None else None
+        if html is not None:
+            metrics.count('cache_hits')
+            try:
+                fields = parse_incident(html, _incident_context(row), row.incident_url, parser,
+                                        metrics)
+                with metrics.timer('write'):
+                    records.add(_incident_record(row, fields))
+            except Exception as ex:
+                # The page is at hand, loading it again would not help.
+                print(row.incident_url)
+                print(ex)
+                metrics.error(ex)
+                continue
+            metrics.count('incidents')
+            continue
+
+        if browser is None and get_browser is not None:
+            browser = get_browser()
+        elif browser is None:
+            browser = webdriver.Chrome(options=chrome_options)
+            print('Starting new browser')
 
         # Get incident URL.
-        url = row['incident_url']
+        url = row.incident_url
         if browser.current_url.find('http') != -1:
             url = _supplement_next_url(url, browser.current_url)
 
-        # print('Querying')
-        browser.get(url)
-        # 1. Wait until the page contains meaningful data.
+        # 1. Load the page.
         try:
-            browser.find_element_or_wait(By.ID, 'block-system-main')
+            with metrics.timer('fetch'):
+                html = scheduler.run(_load_incident_page, browser, url)
         except Exception as ex:
             print(url)
             print(ex)
-            return new_df
+            metrics.error(ex)
+            if i not in requeued and scheduler.is_transient(ex):
+                requeued.add(i)
+                scheduler.requeued()
+                queue.append((i, row))
+            continue
 
-        # 2. Soupify and get incident fields.
-        html = browser.page_source
-        soup = BeautifulSoup(html, features='html5lib')
-        block_system_main = soup.find(id='block-system-main')
+        metrics.count('pages')
 
-        def find_content_div(title):
-            h2 = block_system_main.find('h2', string=title)
-            return h2.parent if h2 else None
+        try:
+            # 2. Soupify and get incident fields.
+            fields = parse_incident(html, _incident_context(row), url, parser, metrics)
+            if cache is not None:
+                cache.put(row.incident_url, html)
+
+            # 3. Add incident fields to the row.
+            with metrics.timer('write'):
+                records.add(_incident_record(row, fields))
+        except Exception as ex:
+            # Not requeued: the page was loaded, it is its content that cannot be parsed.
+            print(url)
+            print(ex)
+            metrics.error(ex)
+            continue
+        metrics.count('incidents')
 
-        location_fields = Scraper.extract_location_fields(find_content_div('Location'), context)
-        participant_fields = Scraper.extract_participant_fields(
-            find_content_div('Participants'))
-        guns_involved_fields = Scraper.extract_guns_involved_fields(
-            find_content_div('Guns Involved')
-        )
-        district_fields = Scraper.extract_district_fields(
-            find_content_div('District')
-        )
+    with metrics.timer('write'):
+        records.flush()
+    if browser is not None and get_browser is None:
+        browser.quit()
+    return records.to_frame()
 
-        incident_characteristics = Scraper.extract_incident_characteristics(
-            find_content_div('Incident Characteristics')
-        )
-        notes = Scraper.extract_notes(find_content_div('Notes'))
-        sources = Scraper.extract_sources(find_content_div('Sources'))
 
-        all_fields = [
-            *location_fields,
-            *participant_fields,
-            *guns_involved_fields,
-            *district_fields,
-            Field('incident_characteristics', incident_characteristics),
-            Field('notes', notes),
-            Field('sources', sources),
-        ]
-
-        # 3. Add incident fields to the row.
-        fields = _normalize(all_fields, url)
-
-        # Temporarily suppress Pandas' SettingWithCopyWarning
-        pd.options.mode.chained_assignment = None
+def _init_worker(scheduler: Scheduler, chrome_options=None, cache=None,
+                 parser=html_parsing.DEFAULT_BACKEND, metrics=None) -> None:
+    global _worker_scheduler, _worker_options, _worker_cache, _worker_parser, _worker_metrics
+    _worker_scheduler = scheduler
+    _worker_options = chrome_options
+    _worker_cache = cache
+    _worker_parser = parser
+    _worker_metrics = metrics
+
+
+def _get_worker_browser():
+    """
+    Browser of a worker of the pool, started on first use and kept for all its chunks.
+    """
+    global _worker_browser
+    if _worker_browser is None:
+        _worker_browser = webdriver.Chrome(options=_worker_options)
+        print('Starting new browser')
+        # Quit the browser when the worker exits.
+        Finalize(_worker_browser, _worker_browser.quit, exitpriority=10)
+    return _worker_browser
+
+
+def _get_worker_metrics() -> Metrics:
+    """
+    Metrics of a worker of the pool, given to _init_worker or started on first use.
+    """
+    global _worker_metrics
+    if _worker_metrics is None:
+        _worker_metrics = Metrics()
+    return _worker_metrics
+
+
+def _scrape_worker_chunk(chunk):
+    return scrape_incidents(chunk, _worker_options, cache=_worker_cache, parser=_worker_parser,
+                            get_browser=_get_worker_browser, metrics=_get_worker_metrics())
+
+
+def _scrape_chunk(idx_and_chunk):
+    '''
+    :returns: (idx, scraped rows, snapshot of the metrics of the chunk)
+    '''
+    idx, chunk = idx_and_chunk
+    return idx, _scrape_worker_chunk(chunk), _get_worker_metrics().snapshot()
+
+
+def scrape_chunks(df, pool, output_fname, chunksize=CHUNKSIZE, metrics=None) -> None:
+    """
+    Hands the incidents of df to the browser workers of the pool, chunksize at a time, so that a
+    slow chunk holds up only its worker. Finished chunks are appended to output_fname (csv) in
+    the order of df, as soon as the chunks before them are done.
+
+    Incidents already in output_fname, from an earlier run that did not finish, are skipped.
+
+    The metrics of the workers are merged into metrics, which reports the progress.
+    """
+    metrics = metrics or Metrics()
+    append = os.path.exists(output_fname)
+    if append:
+        done_urls = set(stage_io.read_stage(output_fname, columns=['incident_url'])['incident_url'])
+        df = df[~df['incident_url'].isin(done_urls)]
+        print('Resuming after {} incidents'.format(len(done_urls)))
+        if metrics.total is not None:
+            metrics.total -= len(done_urls)
+
+    df_chunks = list(chunks(chunksize, df))
+    finished = {}
+    next_idx = 0
+    n_rows = 0
+    with stage_io.StageWriter(output_fname, append=append) as writer:
+        if not append:
+            writer.write(pd.DataFrame([], columns=[*df.columns, *OUTPUT_FIELD_NAMES]))
+        for idx, chunk_df, snapshot in pool.imap_unordered(_scrape_chunk, enumerate(df_chunks)):
+            metrics.merge(snapshot)
+            finished[idx] = chunk_df
+            while next_idx in finished:
+                chunk_df = finished.pop(next_idx)
+                with metrics.timer('write'):
+                    writer.write(chunk_df)
+                n_rows += len(chunk_df)
+                next_idx += 1
+            print('{}/{} chunks done, {} incidents scraped'.format(
+                next_idx + len(finished), len(df_chunks), n_rows))
+            metrics.set_queue_depth(len(df_chunks) - next_idx - len(finished))
+            metrics.report()
+
+
+# —————
+# HTTP-only fetching
+
+def _rebase_url(url: str, base_url: str) -> str:
+    """
+    e.g. _rebase_url('http://www.gunviolencearchive.org/incident/1', 'http://localhost:8000')
+        -> 'http://localhost:8000/incident/1'
+    """
+    base = urlparse(base_url)
+    return urlunparse(urlparse(url)._replace(scheme=base.scheme, netloc=base.netloc))
+
+
+async def _get_page(sess, url: str) -> str:
+    async with sess.get(url) as resp:
+        resp.raise_for_status()
+        return await resp.text()
+
+
+async def fetch_incidents(df, scheduler=None, concurrency=HTTP_CONCURRENCY, base_url=None,
+                          checkpoint_fname=None, flush_every=FLUSH_EVERY, cache=None,
+                          parser=html_parsing.DEFAULT_BACKEND, metrics=None):
+    """
+    Same as scrape_incidents, but downloads the incident pages with plain HTTP requests instead
+    of a browser. At most `concurrency` requests are in flight, and they are paced and retried by
+    the scheduler.
+
+    If base_url is given (e.g. 'http://localhost:8000'), the pages are requested from it instead
+    of from the host of the incident URLs, e.g. to test against a local server of saved pages.
+
+    Rows are kept in the order of df. Incidents whose page cannot be fetched even after being
+    requeued once, or cannot be parsed, are skipped.
+
+    With a cache, pages found in it are not fetched again, and fetched pages are added to it.
+
+    Timings, page and incident counts and errors are recorded in metrics, which reports the
+    progress.
+    """
+    scheduler = scheduler or Scheduler(RPS, retry_on=HTTP_RETRY_ON)
+    metrics = metrics or Metrics()
+    records = RecordBuffer([*df.columns, *OUTPUT_FIELD_NAMES], checkpoint_fname, flush_every)
+    done_urls = records.load_checkpoint()
+    rows = list(df[~df['incident_url'].isin(done_urls)].itertuples(index=False))
+    if done_urls and metrics.total is not None:
+        metrics.total -= len(done_urls)
+
+    queue = asyncio.Queue()
+    for pos in range(len(rows)):
+        queue.put_nowait(pos)
+    requeued = set()
+    results = {}
+    next_pos = 0
+    n_failed = 0
+
+    async def worker(sess):
+        nonlocal next_pos, n_failed
+        while True:
+            pos = await queue.get()
+            row = rows[pos]
+            url = row.incident_url if base_url is None else _rebase_url(row.incident_url, base_url)
+            html = cache.get(row.incident_url) if cache is not None else None
+            is_cached = html is not None
+            if is_cached:
+                metrics.count('cache_hits')
+            try:
+                if not is_cached:
+                    with metrics.timer('fetch'):
+                        html = await scheduler.run_async(_get_page, sess, url)
+                    metrics.count('pages')
+                fields = parse_incident(html, _incident_context(row), row.incident_url, parser, metrics)
+                results[pos] = _incident_record(row, fields)
+                metrics.count('incidents')
+                if cache is not None and not is_cached:
+                    cache.put(row.incident_url, html)
+            except Exception as ex:
+                print(row.incident_url)
+                print(ex)
+                metrics.error(ex)
+                if html is None and pos not in requeued and scheduler.is_transient(ex):
+                    # Try again once the rest of the queue is done.
+                    requeued.add(pos)
+                    scheduler.requeued()
+                    queue.put_nowait(pos)
+                else:
+                    results[pos] = None
+                    n_failed += 1
+
+            try:
+                # Pass the finished rows on in the order of df.
+                while next_pos in results:
+                    record = results.pop(next_pos)
+                    if record is not None:
+                        with metrics.timer('write'):
+                            records.add(record)
+                    next_pos += 1
+                metrics.set_queue_depth(queue.qsize())
+                metrics.report()
+            finally:
+                queue.task_done()
+
+    async with ClientSession(connector=TCPConnector(limit=concurrency)) as sess:
+        workers = [asyncio.ensure_future(worker(sess)) for _ in range(concurrency)]
+        joined = asyncio.ensure_future(queue.join())
+        # Stop as soon as a worker dies, e.g. on a failed write, instead of waiting on the others.
+        await asyncio.wait([joined, *workers], return_when=asyncio.FIRST_COMPLETED)
+        for task in [joined, *workers]:
+            task.cancel()
+        await asyncio.gather(joined, *workers, return_exceptions=True)
+        for task in workers:
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+
+    with metrics.timer('write'):
+        records.flush()
+    print('Fetched {} incidents, {} failed'.format(len(rows) - n_failed, n_failed))
+    if cache is not None:
+        cache.print_stats()
+    return records.to_frame()
+
+
+# —————
+# Offline reparsing
+
+def _reparse_chunk(df, cache_dir: str, parser: str):
+    """
+    Parses the cached pages of the incidents of df.
+
+    Returns (records, number of incidents without a cached page, number of pages that failed to
+    parse, snapshot of the metrics of the chunk).
+    """
+    cache = HttpCache(cache_dir)
+    metrics = Metrics()
+    records = []
+    n_missing = n_failed = 0
+    for row in df.itertuples(index=False):
+        with metrics.timer('fetch'):
+            html = cache.get(row.incident_url)
+        if html is None:
+            n_missing += 1
+            continue
+        metrics.count('cache_hits')
         try:
-            for field_name, field_values in fields:
-                row[field_name] = field_values
+            fields = parse_incident(html, _incident_context(row), row.incident_url, parser, metrics)
+        except Exception as ex:
+            print(row.incident_url)
+            print(ex)
+            metrics.error(ex)
+            n_failed += 1
+            continue
+        records.append(_incident_record(row, fields))
+        metrics.count('incidents')
+    return records, n_missing, n_failed, metrics.snapshot()
 
-            new_df = new_df.append(row)
-        finally:
-            pd.options.mode.chained_assignment = 'warn'
 
-    sleep(3)
-    return new_df
+def reparse_incidents(df, cache_dir=http_cache.CACHE_DIR, workers=None, chunksize=REPARSE_CHUNKSIZE,
+                      parser=html_parsing.DEFAULT_BACKEND, metrics=None):
+    """
+    Builds the rows of scrape_incidents from the pages in the cache only, without any request.
+    The incidents are parsed by `workers` processes (default: one per core), `chunksize`
+    incidents at a time.
 
+    Rows are kept in the order of df. Incidents without a cached page are skipped.
 
-def main():
-    args = parse_args()
+    The metrics of the workers are merged into metrics, which reports the progress.
+    """
+    metrics = metrics or Metrics()
+    records = []
+    n_missing = n_failed = 0
+    n_chunks = ceil(len(df) / chunksize)
+    with ProcessPoolExecutor(workers) as executor:
+        results = executor.map(_reparse_chunk, chunks(chunksize, df), repeat(cache_dir), repeat(parser))
+        for n_done, (chunk_records, chunk_missing, chunk_failed, snapshot) in enumerate(results, 1):
+            records.extend(chunk_records)
+            n_missing += chunk_missing
+            n_failed += chunk_failed
+            metrics.merge(snapshot)
+            metrics.set_queue_depth(n_chunks - n_done)
+            metrics.report()
+
+    print('Reparsed {} incidents, {} not cached, {} failed'.format(len(records), n_missing, n_failed))
+    return pd.DataFrame(records, columns=[*df.columns, *OUTPUT_FIELD_NAMES])
 
-    df = load_input(args)
 
-    options = webdriver.ChromeOptions()
-    if args.should_use_headless:
-        options.add_argument('--headless')
+# —————
+# Persistent job queue
+
+def queue_incidents(queue: JobQueue, df) -> None:
+    """
+    Adds the incidents of df to the queue, keyed by URL. Incidents already in it keep their state.
+    """
+    n_new = queue.add((url, None) for url in df['incident_url'])
+    print('Queued {} new incidents'.format(n_new))
+    queue.print_counts()
+
+
+def _fields_result(fields) -> list:
+    """
+    Scraped fields of a row, in the order of OUTPUT_FIELD_NAMES, as JSON serializable values.
+    """
+    return [None if pd.isna(value) else getattr(value, 'item', lambda: value)() for value in fields]
 
-    # new_df = scrape_incidents(df, options)
 
-    def split(a, n):
-        k, m = divmod(len(a), n)
-        return (a[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n))
+def drain_queue(queue: JobQueue, df, scrape, chunksize=QUEUE_CHUNKSIZE, metrics=None) -> None:
+    """
+    Claims incidents of df from the queue, chunksize at a time, and scrapes them with
+    scrape(chunk), which returns the rows it could scrape, until none is left to claim.
+    The scraped fields are stored as the results of the jobs, and incidents missing from the rows
+    are marked as failed.
 
-    # print(list(split(df, mp.cpu_count() - 1)))
+    metrics reports the progress, with the pending jobs as the queue depth.
+    """
+    metrics = metrics or Metrics()
+    while True:
+        jobs = queue.claim(chunksize)
+        if not jobs:
+            return
+
+        urls = [url for url, _ in jobs]
+        scraped = scrape(df[df['incident_url'].isin(urls)])
+        scraped = scraped.drop_duplicates('incident_url').set_index('incident_url')
+        for url in urls:
+            if url in scraped.index:
+                queue.done(url, _fields_result(scraped.loc[url, OUTPUT_FIELD_NAMES]))
+            else:
+                queue.failed(url, 'Could not be scraped')
+        metrics.set_queue_depth(queue.counts()[PENDING])
+        metrics.report()
 
-    # num_threads = (mp.cpu_count() // 2) - 1
-    num_threads = 5
-    df = df[:num_threads * 10]
-    dfs = list(split(df, num_threads))
-    args_list = [(df, options, idx) for idx, df in enumerate(dfs)]
 
-    # with mp.Pool(num_threads) as pool:
-    with mp.Pool(num_threads) as pool:
-        result = pool.starmap(scrape_incidents, args_list)
+def queue_output(queue: JobQueue, df):
+    """
+    Builds the rows of the incidents of df that are done in the queue, in the order of df.
+    """
+    fields = dict(queue.results())
+    done = df[df['incident_url'].isin(fields.keys())]
+    records = [(*row, *fields[row.incident_url]) for row in done.itertuples(index=False)]
+    return pd.DataFrame(records, columns=[*df.columns, *OUTPUT_FIELD_NAMES])
+
+
+def _scrape_queue(queue: JobQueue, df, chunksize) -> None:
+    drain_queue(queue, df, _scrape_worker_chunk, chunksize, _get_worker_metrics())
+    _get_worker_metrics().summary()
+
+
+def write_queue_output(args, queue: JobQueue, df) -> None:
+    queue.print_counts()
+    if not queue.is_finished():
+        print('Other workers are still processing the queue, rerun once they are done to write the output.')
+        return
+    write_output(args, queue_output(queue, df))
+    print('Wrote.')
 
-    print('Done scraping. Now writing.')
 
-    new_df = pd.concat(result)
-    write_output(args, new_df)
+def main():
+    args = parse_args()
+
+    df = load_input(args)
+    if args.limit is not None:
+        df = df[:args.limit]
+    cache = None if args.no_cache else HttpCache(args.cache_dir, args.cache_size * 1024 ** 2)
+
+    queue = None
+    if args.queue_fname and not args.reparse:
+        queue = JobQueue(args.queue_fname)
+        if args.retry_failed:
+            print('Retrying {} failed incidents'.format(queue.retry_failed()))
+        queue_incidents(queue, df)
+
+    # With a queue, the incidents done in earlier runs are not scraped again.
+    total = len(df) if queue is None else sum(queue.counts()[state] for state in (PENDING, IN_FLIGHT))
+    run_metrics = Metrics('stage2', total, fname=args.metrics_fname, interval=args.metrics_interval)
+
+    if args.reparse:
+        new_df = reparse_incidents(df, args.cache_dir, args.workers, parser=args.parser,
+                                   metrics=run_metrics)
+        run_metrics.summary()
+        write_output(args, new_df)
+        print('Wrote.')
+        return
+
+    if args.use_http:
+        scheduler = Scheduler(args.rps, retry_on=HTTP_RETRY_ON, max_retries=args.max_retries)
+
+        def fetch(df, checkpoint_fname=None):
+            return asyncio.run(fetch_incidents(
+                df,
+                scheduler=scheduler,
+                concurrency=args.concurrency,
+                base_url=args.base_url,
+                checkpoint_fname=checkpoint_fname,
+                flush_every=args.flush_every,
+                cache=cache,
+                parser=args.parser,
+                metrics=run_metrics,
+            ))
+
+        if queue is not None:
+            drain_queue(queue, df, fetch, chunksize=max(QUEUE_CHUNKSIZE, args.concurrency),
+                        metrics=run_metrics)
+            run_metrics.summary()
+            scheduler.print_stats()
+            write_queue_output(args, queue, df)
+            return
+
+        new_df = fetch(df, checkpoint_fname(args.output_fname, 0))
+        run_metrics.summary()
+        scheduler.print_stats()
+        write_output(args, new_df)
+        print('Wrote.')
+        remove_checkpoints(args.output_fname, 1)
+        return
+
+    options = webdriver.ChromeOptions()
+    if args.should_use_headless:
+        options.add_argument('--headless')
+
+    # Enough browsers to use the request budget, as long as there are cores to run them.
+    workers = args.workers or max(1, min(cpu_count(), ceil(args.rps * PAGE_LOAD_SECONDS)))
+    print('Scraping with {} browsers'.format(workers))
+
+    # All the browsers share one request budget.
+    scheduler = Scheduler(args.rps, retry_on=CHROME_RETRY_ON, max_retries=args.max_retries)
+    initargs = (scheduler, options, cache, args.parser, run_metrics)
+
+    if queue is not None:
+        # Every worker reports its own progress.
+        run_metrics.total = None
+        with mp.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+            pool.starmap(_scrape_queue, [(queue, df, args.chunksize)] * workers)
+        scheduler.print_stats()
+        write_queue_output(args, queue, df)
+        return
+
+    # The rows are streamed to a csv next to the output, which is kept if the run does not finish.
+    partial_fname = checkpoint_fname(args.output_fname, 0)
+    with mp.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+        scrape_chunks(df, pool, partial_fname, args.chunksize, run_metrics)
+
+    print('Done scraping.')
+    run_metrics.summary()
+    scheduler.print_stats()
+
+    if stage_io.is_columnar(args.output_fname):
+        stage_io.convert(partial_fname, args.output_fname)
+        os.remove(partial_fname)
+    else:
+        os.replace(partial_fname, args.output_fname)
     print('Wrote.')
 
 
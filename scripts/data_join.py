@@ -3,53 +3,66 @@ Module used for joining population, house pricing, and gun violence datasets
 together. 
 '''
 
-import math
 import pandas as pd
 import argparse
 import cleaning
+import hashlib
+import ingest
+import inspect
+import os
+import stage_io
 import numpy as np
 import csv
 
+# The cube is keyed by month; coarser resolutions are rolled up from it.
+CUBE_KEYS = ["State", "City", "Year", "Month"]
+CUBE_PATH = "../data/joined_cube.csv"
+
+# Group keys of each resolution, written to ../data/joined_<resolution>.csv
+RESOLUTIONS = {
+    "agg": ["State", "City"],
+    "yearly": ["State", "City", "Year"],
+    "monthly": CUBE_KEYS,
+}
+
+# Columns summed over the joined rows, and columns averaged over them
+SUM_COLUMNS = ["Killed", "Injured"]
+MEAN_COLUMNS = ["Population", "Houses", "TotalArea", "LandArea",
+                "PopDensity", "HouseDensity", "HousingPrice"]
+
+# Loaded and joined frames are pickled here, keyed by their inputs and code
+CACHE_DIR = "../data/.join_cache"
+
 
 def load_housing(path):
     '''
     Loads the housing data csv.
     :returns: DataFrame with columns ["State", "City", "Year", "Month", "HousingPrice"]
     '''
-    housing = pd.read_csv(housing_path, header=0)
-
-    # Clean data into new_rows
-    new_rows = []
-    for i, col in housing.iterrows():
-        city = ""
-        state = ""
-        # Iterate over each column in each row
-        for y, x in enumerate(col):
-            # The second column ('RegionName') contains the city name
-            if y == 1:
-                # lowercase the city name and make it a-z chars
-                city = cleaning.clean_housing_city(x, col)
-            if y == 2:
-                state = cleaning.standardized_state(x)
-            # After column six we get into the monthly price data (starting with 1996-04)
-            if y > 5 and not math.isnan(x):
-                # calculate the month based on the column
-                month = (y-3) % 12 + 1
-                # calculate the year based on the column
-                year = (y-3) // 12 + 1994
-                # add row to new dataframe
-                row = [city, state, year, month, int(x)]
-                new_rows.append(row)
-
-    # Load new_rows into df
-    new_housing = pd.DataFrame(
-        new_rows, columns=["City", "State", "Year", "Month", "HousingPrice"])
-    new_housing = new_housing[new_housing["Year"] > 2013]
-    new_housing = new_housing[(new_housing["Year"] < 2018) | ((new_housing["Month"] < 4) & (new_housing["Year"] == 2018))]
-
-
-    cols = ["State", "City", "Year", "Month", "HousingPrice"]
-    new_housing = new_housing[cols]
+    housing = pd.read_csv(path, header=0)
+
+    # After column six we get into the monthly price data (starting with 1996-04),
+    # keep only the months that overlap with the gun violence data
+    prices = housing.iloc[:, 6:]
+    dates = pd.to_datetime(prices.columns, format="%Y-%m")
+    in_window = (dates >= "2014-01") & (dates < "2018-04")
+
+    # reshape to one row per city and month
+    rows, years, months, values = ingest.melt_monthly(prices.loc[:, in_window])
+
+    # The second column ('RegionName') contains the city name
+    cities = cleaning.normalize_series(housing.iloc[:, 1],
+                                       cleaning.clean_housing_city)
+    states = cleaning.normalize_series(housing.iloc[:, 2],
+                                       cleaning.standardized_state)
+
+    new_housing = pd.DataFrame({
+        "State": states.to_numpy()[rows],
+        "City": cities.to_numpy()[rows],
+        "Year": years,
+        "Month": months,
+        "HousingPrice": values,
+    })
 
     return new_housing
 
@@ -59,17 +72,17 @@ def load_population(path):
     Loads the population data csv.
     :returns: DataFrame with columns ["State", "City", "Population", "Houses", "TotalArea", "LandArea", "PopDensity", "HouseDensity"]
     '''
-    raw_data = pd.read_csv(population_path, header=1)
+    raw_data = pd.read_csv(path, header=1)
     cols = ["State", "City", "Population", "Houses",
             "TotalArea", "LandArea", "PopDensity", "HouseDensity"]
     # extract important columns
     data = raw_data.iloc[:, [2, 5, 7, 8, 9, 11, 12, 13]]
     data.columns = cols
     # clean all the columns
-    data.loc[:, "State"] = data.loc[:, "State"].apply(
-        cleaning.standardized_state)
-    data.loc[:, "City"] = data.loc[:, "City"].apply(
-        cleaning.clean_pop_city_county)
+    data.loc[:, "State"] = cleaning.normalize_series(
+        data.loc[:, "State"], cleaning.standardized_state)
+    data.loc[:, "City"] = cleaning.normalize_series(
+        data.loc[:, "City"], cleaning.clean_pop_city_county)
     for i in ["Population", "Houses"]:
         data.loc[:, i] = data.loc[:, i].apply(cleaning.clean_pop_int)
     for i in ["TotalArea", "LandArea", "PopDensity", "HouseDensity"]:
@@ -82,28 +95,25 @@ def load_population(path):
 
 def load_gun_violence(path):
     '''
-    Loads the gunviolence data csv.
+    Loads the gunviolence data (stage 3 output, csv or columnar).
     :returns: DataFrame
     '''
-    raw_data = pd.read_csv(gun_violence_path, header=0)
-    data = raw_data.loc[:, ["date", "state",
-                            "city_or_county", "n_killed", "n_injured"]]
-    cols = ["Year", "State", "City", "Killed", "Injured"]
+    data = stage_io.read_stage(path, columns=["date", "state",
+                                              "city_or_county", "n_killed", "n_injured"])
+    cols = ["Date", "State", "City", "Killed", "Injured"]
     data.columns = cols
-    data["Month"] = data["Year"]
     # clean the columns
-    data.loc[:, "State"] = data.loc[:, "State"].apply(
-        cleaning.standardized_state)
-    data.loc[:, "City"] = data.loc[:, "City"].apply(cleaning.clean_gv_city)
+    data.loc[:, "State"] = cleaning.normalize_series(
+        data.loc[:, "State"], cleaning.standardized_state)
+    data.loc[:, "City"] = cleaning.normalize_series(
+        data.loc[:, "City"], cleaning.clean_gv_city)
     for i in ["Killed", "Injured"]:
         data.loc[:, i] = data.loc[:, i].apply(lambda x: int(x))
     # discard county data
     data = data.loc[data["City"] != "COUNTYDATA"]
     # break data into month, year fields
-    data.loc[:, "Month"] = data.loc[:, "Month"].apply(
-        lambda x: int(x.split("-")[1]))
-    data.loc[:, "Year"] = data.loc[:, "Year"].apply(
-        lambda x: int(x.split("-")[0]))
+    data["Month"] = data["Date"].dt.month
+    data["Year"] = data["Date"].dt.year
 
     # reorder cols
     cols = ["State", "City", "Year", "Month", "Killed", "Injured"]
@@ -113,6 +123,60 @@ def load_gun_violence(path):
     return data
 
 
+def file_digest(path):
+    '''
+    :returns: sha1 of the content of a file
+    '''
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(paths=(), code=(), keys=()):
+    '''
+    Hashes everything a cached frame depends on, so that it is rebuilt when
+    any of it changes.
+    :param paths: input files, hashed by content
+    :param code: functions and modules whose source the frame is built by
+    :param keys: cache keys of the frames it is built from
+    '''
+    digest = hashlib.sha1(pd.__version__.encode())
+    for path in paths:
+        digest.update(file_digest(path).encode())
+    for obj in code:
+        digest.update(inspect.getsource(obj).encode())
+    for key in keys:
+        digest.update(key.encode())
+    return digest.hexdigest()
+
+
+def cached(name, key, build, cache_dir=CACHE_DIR, use_cache=True):
+    '''
+    Returns the frame cached under name and key, or builds it with build() and
+    caches it, replacing the frames cached under name with other keys.
+    :param use_cache: if False, always build the frame, and do not cache it
+    '''
+    if not use_cache:
+        return build()
+
+    path = os.path.join(cache_dir, "{}.{}.pkl".format(name, key))
+    if os.path.exists(path):
+        print("Loaded {} from the cache".format(name))
+        return pd.read_pickle(path)
+
+    data = build()
+    os.makedirs(cache_dir, exist_ok=True)
+    for fname in os.listdir(cache_dir):
+        if fname.startswith(name + "."):
+            os.remove(os.path.join(cache_dir, fname))
+    # written under another name first, so that a partial file is never loaded
+    data.to_pickle(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return data
+
+
 def analyze_david(housing, population, gun_violence) -> None:
     """
     Random fns
@@ -185,11 +249,108 @@ H/P difference in H: {list(dropped_h_p_from_h)[1 :: len(dropped_h_p_from_h) // 2
     pass
 
 
+def aggregate_gun_violence(gun_violence):
+    '''
+    Totals the incidents of every city and month, so that the joins are on
+    one row per month instead of one per incident.
+    :returns: DataFrame with columns CUBE_KEYS + ["Killed", "Injured", "NumIncidents"]
+    '''
+    groups = gun_violence.groupby(CUBE_KEYS)
+    data = groups[SUM_COLUMNS].sum()
+    data["NumIncidents"] = groups["Killed"].count()
+    return data.reset_index()
+
+
+def join_sources(housing, population, gun_violence):
+    '''
+    :returns: DataFrame with one row per housing price and matching population row, and the incident totals of the month
+    '''
+    # total the incidents by month before joining, resulting in table ["State", "City", "Year", "Month", "Killed", "Injured", "NumIncidents"]
+    gun_violence_monthly = aggregate_gun_violence(gun_violence)
+
+    # joining housing and gv on ["State", "City", "Month", "Year"] resulting in table ["State", "City", "Year", "Month", "HousingPrice", "Killed", "Injured", "NumIncidents"]
+    housing_gv_joined = housing.merge(gun_violence_monthly, left_on=["State", "City", "Month", "Year"], right_on=[
+                                      "State", "City", "Month", "Year"], how="left")
+
+    # joining housing_gv_joined and population on  ["State", "City"]
+    return housing_gv_joined.merge(
+        population, left_on=["State", "City"], right_on=["State", "City"], how="inner")
+
+
+def build_cube(joined):
+    '''
+    Aggregates the joined rows by month. The means are kept as sums along with
+    the number of rows they are over, so that every resolution can be rolled
+    up exactly.
+
+    Each joined row carries the totals of aggregate_gun_violence, missing for
+    months without incidents. It stands for the NumIncidents rows a join with
+    the individual incidents would have, or for one row without incidents, and
+    weighs that much in the means.
+    :returns: DataFrame with columns CUBE_KEYS + ["Killed", "Injured", "NumIncidents", "Rows"] and a "<column>Sum" column for each of MEAN_COLUMNS
+    '''
+    num_incidents = joined["NumIncidents"].fillna(0).astype("int64")
+    rows = num_incidents.clip(lower=1)
+    # none of MEAN_COLUMNS has missing values, so they are all averaged over every row
+    sums = joined[MEAN_COLUMNS].mul(rows, axis=0).add_suffix("Sum")
+
+    data = pd.concat([joined[CUBE_KEYS + SUM_COLUMNS], sums], axis=1)
+    data.insert(len(CUBE_KEYS) + len(SUM_COLUMNS), "NumIncidents", num_incidents)
+    data.insert(len(CUBE_KEYS) + len(SUM_COLUMNS) + 1, "Rows", rows)
+    return data.groupby(CUBE_KEYS, as_index=False).sum()
+
+
+def rollup(cube, resolution):
+    '''
+    :param resolution: one of RESOLUTIONS
+    :returns: DataFrame with columns ["State", "City", (Year, Month,) "Killed", "Injured", "AvgKilled", "AvgInjured", *MEAN_COLUMNS, "NumIncidents"]
+    '''
+    group_on = RESOLUTIONS[resolution]
+    totals = cube.groupby(group_on).sum(numeric_only=True)
+
+    data = totals[SUM_COLUMNS].copy()
+    # average per incident, missing for places without incidents
+    data["AvgKilled"] = totals["Killed"] / totals["NumIncidents"]
+    data["AvgInjured"] = totals["Injured"] / totals["NumIncidents"]
+    for col in MEAN_COLUMNS:
+        data[col] = totals[col + "Sum"] / totals["Rows"]
+    data["NumIncidents"] = totals["NumIncidents"]
+
+    return data.reset_index()
+
+
+def write_cube(cube, path):
+    if stage_io.is_columnar(path):
+        stage_io.write_stage(cube, path)
+    else:
+        # full precision, the sums are rolled up again
+        cube.to_csv(path, index=False)
+
+
+def read_cube(path=CUBE_PATH):
+    if stage_io.is_columnar(path):
+        return stage_io.read_stage(path)
+    return pd.read_csv(path)
+
+
+def load_joined(resolution, path=CUBE_PATH):
+    '''
+    Loads a resolution of the joined data from the cube written by this
+    module, without reloading the sources.
+    :param resolution: one of RESOLUTIONS
+    '''
+    return rollup(read_cube(path), resolution)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Join multiple datasets")
-    parser.add_argument("--monthly", help="Compile the data with a monthly resolution",
+    parser.add_argument("--monthly", help="Only write the data with a monthly resolution",
                         action="store_true")
-    parser.add_argument("--yearly", help="Compile the data with a yearly resoultion",
+    parser.add_argument("--yearly", help="Only write the data with a yearly resolution",
+                        action="store_true")
+    parser.add_argument("--cube", help="Where to save the monthly cube that every resolution is rolled up from (.csv, .parquet or .feather, default: {})".format(CUBE_PATH),
+                        default=CUBE_PATH)
+    parser.add_argument("--no-cache", help="Reload and join the sources even if they did not change since the last run, and do not cache them",
                         action="store_true")
     args = parser.parse_args()
 
@@ -197,50 +358,41 @@ if __name__ == "__main__":
     housing_path = "../data/housing_city_monthly.csv"
     population_path = "../data/population.csv"
     gun_violence_path = "../data/stage3.csv"
-    save_path = "../data/joined"
+    save_path = "../data/joined_{}.csv"
     if args.monthly:
-        save_path += "_monthly.csv"
+        resolutions = ["monthly"]
     elif args.yearly:
-        save_path += "_yearly.csv"
+        resolutions = ["yearly"]
     else:
-        save_path += "_agg.csv"
-
-    # load csv's into dataframes
-    housing = load_housing(housing_path)
-    population = load_population(population_path)
-    gun_violence = load_gun_violence(gun_violence_path)
+        resolutions = list(RESOLUTIONS)
+
+    # load csv's into dataframes, or their cached copies if neither the
+    # files nor the cleaning code changed since they were cached
+    use_cache = not args.no_cache
+    housing_key = cache_key([housing_path], [load_housing, cleaning, ingest.melt_monthly])
+    housing = cached("housing", housing_key,
+                     lambda: load_housing(housing_path), use_cache=use_cache)
+    population_key = cache_key([population_path], [load_population, cleaning])
+    population = cached("population", population_key,
+                        lambda: load_population(population_path), use_cache=use_cache)
+    gun_violence_key = cache_key([gun_violence_path], [load_gun_violence, cleaning, stage_io])
+    gun_violence = cached("gun_violence", gun_violence_key,
+                          lambda: load_gun_violence(gun_violence_path), use_cache=use_cache)
 
     # David's Analysis
     analyze_david(housing, population, gun_violence)
 
-    # joining housing and gv on ["State", "City", "Month", "Year"] resulting in table ["State", "City", "Year", "Month", "HousingPrice", "Killed", "Injured"]
-    housing_gv_joined = housing.merge(gun_violence, left_on=["State", "City", "Month", "Year"], right_on=[
-                                      "State", "City", "Month", "Year"], how="left")
+    joined_key = cache_key(code=[join_sources, aggregate_gun_violence],
+                           keys=[housing_key, population_key, gun_violence_key])
+    housing_gv_population_joined = cached(
+        "joined", joined_key, lambda: join_sources(housing, population, gun_violence), use_cache=use_cache)
 
-    # joining housing_gv_joined and population on  ["State", "City"]
-    housing_gv_population_joined = housing_gv_joined.merge(
-        population, left_on=["State", "City"], right_on=["State", "City"], how="inner")
+    # aggregate by month once, and roll every resolution up from it
+    cube = build_cube(housing_gv_population_joined)
+    write_cube(cube, args.cube)
+    print("Wrote the cube to {}".format(args.cube))
 
-    group_on = ["State", "City"]
-    if args.monthly:
-        group_on.append("Year")
-        group_on.append("Month")
-    elif args.yearly:
-        group_on.append("Year")
-
-    condensed_dataset = pd.DataFrame()
-
-    # compute the columns that are sums
-    condensed_dataset_sums = housing_gv_population_joined.groupby(group_on)[
-        "Killed", "Injured"].sum()
-    # compute the columns that are means
-    condensed_dataset_avgs = housing_gv_population_joined.groupby(
-        group_on)["Killed", "Injured", "Population", "Houses", "TotalArea", "LandArea"].mean()
-    condensed_dataset_avgs.rename(
-        columns={"Killed": "AvgKilled", "Injured": "AvgInjured"}, inplace=True)
-    # join sums an dmeans
-    condensed_data = condensed_dataset_sums.merge(condensed_dataset_avgs, on=group_on, how="inner")
-    condensed_data.reset_index()
-    # compute the columns that are counts
-    condensed_dataset_counts = housing_gv_population_joined.groupby(group_on, as_index=False)[ "Killed"].count()
-    condensed_dataset_counts.rename(columns = {"Killed":"NumIncidents"}, inplace=True)
+    for resolution in resolutions:
+        path = save_path.format(resolution)
+        rollup(cube, resolution).to_csv(path)
+        print("Wrote {}".format(path))
@@ -1,94 +1,64 @@
-import sqlite3
-import csv
+import argparse
+
+import ingest
 
 '''
     Creates the gunviolence table and add it to data.db
 '''
 
-conn = sqlite3.connect('../data.db')
-c = conn.cursor()
-
-# Delete tables if they exist
-c.execute('DROP TABLE IF EXISTS "gunviolence";')
-conn.commit()
-
-# Create gunviolence table
-# NOTE: the first two rows are titles of what the data contains
-c.execute(
-    'CREATE TABLE gunviolence( \
-        incident_id int primary key, \
-        date varchar(100) , \
-        state varchar(100), \
-        city_or_county varchar(100), \
-        address varchar(100), \
-        n_killed int, \
-        n_injured int, \
-        incident_url varchar(10000), \
-        source_url varchar(10000), \
-        incident_url_fields_missing bool, \
-        congressional_district int \
-        gun_stolen varchar(10000), \
-        gun_type varchar(10000), \
-        incident_characteristics varchar(10000), \
-        latitude float, \
-        location_description varchar(10000), \
-        longitude float, \
-        n_guns_involved int, \
-        notes varchar(10000), \
-        participant_age varchar(10000), \
-        participant_age_group varchar(10000), \
-        participant_gender varchar(10000), \
-        participant_name varchar(10000), \
-        participant_relationship varchar(10000), \
-        participant_status varchar(10000), \
-        participant_type varchar(10000), \
-        sources varchar(10000), \
-        state_house_district int, \
-        state_senate_district int \
-    )')
-conn.commit()
-
-
-# get rid of the revision field and returns a float
-def getFloat(field):
-    # when the data doesn't exist
-    if field == None or field == "":
-        return None
 
-    return float(field)
+def bulk_load(conn, filename, batch_size=10000, chunksize=100000,
+              journal_mode='WAL', synchronous='OFF', commit_every=0,
+              resume=False):
+    '''
+    Loads the csv in batches of batch_size rows using executemany.
 
+    Everything is inserted in a single transaction unless commit_every is set,
+    in which case the transaction is committed every commit_every batches.
+    Committed rows are never re-inserted when resume is set: the rows already
+    in the table are skipped in the csv, which is read in the same order.
 
-def getInt(field):
-    # when the data doesn't exist
-    if field == None or field == "":
-        return None
-    return int(field)
+    :returns: number of rows inserted by this call
+    '''
+    if resume:
+        n_skip = conn.execute('SELECT COUNT(*) FROM gunviolence').fetchone()[0]
+        print("Skipping {} rows loaded by a previous run".format(n_skip))
+    else:
+        ingest.recreate_table(conn, "gunviolence", ingest.GUNVIOLENCE_SCHEMA)
+        n_skip = 0
 
+    frames = ingest.read_gunviolence(filename, chunksize=chunksize, skip=n_skip)
+    return ingest.bulk_insert(conn, "gunviolence", frames,
+                              batch_size=batch_size,
+                              journal_mode=journal_mode,
+                              synchronous=synchronous,
+                              commit_every=commit_every)
 
-def read_data(filename):
-    with open(filename) as f:
-        reader = csv.reader(f)
-        i = 0
-        for row in reader:
-            if i == 0:
-                i = 1
-            else:
-                c.execute('INSERT INTO gunviolence VALUES \
-                    (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, \
-                        ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                          (getInt(row[0]), row[1], row[2], row[3],
-                           (row[4]), getInt(row[5]), getInt(row[6]),
-                              row[7], (row[8]), (row[9]), getInt(row[10]),
-                              (row[11]), (row[12]), (row[13]),
-                              getFloat(row[14]), (row[15]), getFloat(row[16]),
-                              getInt(row[17]), (row[18]), (row[19]),
-                              (row[20]), (row[21]), (row[22]),
-                              (row[23]), (row[24]), (row[25]),
-                              (row[26]), (row[27])
-                           ))
-                conn.commit()
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load the gunviolence csv into data.db")
+    parser.add_argument("--batch-size", help="Number of rows per executemany call",
+                        type=int, default=10000)
+    parser.add_argument("--chunksize", help="Number of csv rows parsed at a time",
+                        type=int, default=100000)
+    parser.add_argument("--journal-mode", help="SQLite journal_mode used during the load",
+                        default="WAL")
+    parser.add_argument("--synchronous", help="SQLite synchronous setting used during the load",
+                        default="OFF")
+    parser.add_argument("--commit-every", help="Commit every N batches so an interrupted load can be resumed (0 = single transaction)",
+                        type=int, default=0)
+    parser.add_argument("--resume", help="Continue an interrupted load instead of recreating the table",
+                        action="store_true")
+    args = parser.parse_args()
 
-read_data('../data/stage3.csv')
+    conn = ingest.connect()
+    bulk_load(conn, '../data/stage3.csv',
+              batch_size=args.batch_size,
+              chunksize=args.chunksize,
+              journal_mode=args.journal_mode,
+              synchronous=args.synchronous,
+              commit_every=args.commit_every,
+              resume=args.resume)
 
-print("Finished reading data from gunviolence1.csv to the database.")
+    print("Finished reading data from gunviolence1.csv to the database.")
@@ -0,0 +1,40 @@
+'''
+HTML parser backends of the scraping stages.
+
+The backend names are the BeautifulSoup tree builders. html5lib is the most
+lenient but by far the slowest; lxml gives the same results on the archive's
+pages in a fraction of the time. With the lxml backend, the result pages of
+stage 1 are read with lxml directly, without BeautifulSoup, and the incident
+pages of stage 2 only build the tree of their main block.
+
+See bench_parsers.py to compare the backends on saved pages.
+'''
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+BACKENDS = ['lxml', 'html.parser', 'html5lib']
+DEFAULT_BACKEND = 'lxml'
+
+
+def make_soup(html: str, backend=DEFAULT_BACKEND, only_id=None) -> BeautifulSoup:
+    '''
+    :param only_id: if given, only the element with this id and its descendants are parsed
+        (ignored by html5lib, which cannot parse part of a document)
+    '''
+    parse_only = SoupStrainer(id=only_id) if only_id and backend != 'html5lib' else None
+    return BeautifulSoup(html, features=backend, parse_only=parse_only)
+
+
+def parse_lxml(html: str):
+    '''
+    :returns: root lxml.html element of the document
+    '''
+    import lxml.html
+    return lxml.html.fromstring(html)
+
+
+def xpath_has_class(cls: str) -> str:
+    '''
+    XPath predicate equivalent to the CSS selector .cls
+    '''
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(cls)
@@ -0,0 +1,131 @@
+'''
+On-disk cache of the pages downloaded by the scraping stages.
+
+Pages are stored gzipped, one file per URL, under a directory named after a
+hash of the normalized URL. Session tokens added to the query string (see
+d_stage2._supplement_next_url) are not part of the key, so a page fetched in
+one session is found again in the next. When the cache grows past its size
+cap, the least recently used pages are evicted.
+'''
+
+import gzip
+import hashlib
+import os
+from tempfile import NamedTemporaryFile
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+CACHE_DIR = '.http_cache'
+MAX_BYTES = 2 * 1024 ** 3
+
+# Query parameters that select the content of a page. Every other one is dropped from the key.
+KEY_PARAMS = ['page']
+
+# Share of the size cap that eviction brings the cache back down to.
+EVICT_TO = 0.9
+
+SUFFIX = '.html.gz'
+
+
+def normalize_url(url: str) -> str:
+    '''
+    e.g. normalize_url('https://www.GunViolenceArchive.org/query/abc?page=2&sid=xyz')
+        -> 'http://www.gunviolencearchive.org/query/abc?page=2'
+    '''
+    parsed = urlparse(url)
+    params = sorted((k, v) for k, v in parse_qsl(parsed.query) if k in KEY_PARAMS)
+    return urlunparse(('http', parsed.netloc.lower(), parsed.path, '', urlencode(params), ''))
+
+
+class HttpCache(object):
+    '''
+    :param cache_dir: directory of the cache, created if needed
+    :param max_bytes: size cap of the compressed pages
+    '''
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # Size on disk, scanned on the first write.
+        self._n_bytes = None
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, url: str) -> str:
+        digest = hashlib.sha1(normalize_url(url).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + SUFFIX)
+
+    def get(self, url: str):
+        '''
+        :returns: the cached page of url, or None
+        '''
+        fname = self.path(url)
+        try:
+            with gzip.open(fname, 'rt', encoding='utf-8') as f:
+                text = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        # The mtime is the last use of the page, for eviction.
+        try:
+            os.utime(fname)
+        except FileNotFoundError:
+            # Evicted by another worker since it was read; the text is still good.
+            pass
+        self.hits += 1
+        return text
+
+    def put(self, url: str, text: str) -> None:
+        fname = self.path(url)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+        # Written to a temporary file first, so that a page is never read half written.
+        with NamedTemporaryFile(dir=os.path.dirname(fname), suffix='.tmp', delete=False) as f:
+            f.write(gzip.compress(text.encode('utf-8')))
+        old_size = os.path.getsize(fname) if os.path.exists(fname) else 0
+        os.replace(f.name, fname)
+
+        if self._n_bytes is None:
+            self._n_bytes = sum(size for _, _, size in self._entries())
+        else:
+            self._n_bytes += os.path.getsize(fname) - old_size
+        if self._n_bytes > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        '''
+        :returns: generator of (mtime, file name, size) of the cached pages
+        '''
+        if not os.path.isdir(self.cache_dir):
+            return
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith(SUFFIX):
+                    stat = entry.stat()
+                    yield stat.st_mtime, entry.path, stat.st_size
+
+    def evict(self) -> None:
+        '''
+        Removes the least recently used pages until the cache is back under its size cap.
+        '''
+        entries = sorted(self._entries())
+        n_bytes = sum(size for _, _, size in entries)
+        target = self.max_bytes * EVICT_TO
+        n_evicted = 0
+        for _, fname, size in entries:
+            if n_bytes <= target:
+                break
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                # Evicted by another worker
+                pass
+            n_bytes -= size
+            n_evicted += 1
+        self._n_bytes = n_bytes
+        print('Evicted {} page(s) from the cache'.format(n_evicted))
+
+    def print_stats(self) -> None:
+        print('Cache: {} hit(s), {} miss(es)'.format(self.hits, self.misses))
@@ -0,0 +1,397 @@
+'''
+Shared helpers for loading the source csv files into data.db.
+
+Each source is parsed with vectorized pandas operations into a DataFrame
+whose columns match the table layout, and then inserted with executemany
+in batches inside a single transaction.
+'''
+
+import sqlite3
+from time import time
+
+import numpy as np
+import pandas as pd
+
+import cleaning
+
+DB_PATH = '../data.db'
+
+
+def connect(path=DB_PATH):
+    '''
+    Opens the database in autocommit mode so that transactions are managed
+    explicitly by bulk_insert.
+    '''
+    return sqlite3.connect(path, isolation_level=None)
+
+
+def recreate_table(conn, name, schema):
+    '''
+    Drops the table if it exists and creates it again.
+    :param schema: the column definitions, e.g. "city varchar(100), price int"
+    '''
+    c = conn.cursor()
+    c.execute('DROP TABLE IF EXISTS "{}";'.format(name))
+    c.execute('CREATE TABLE {}({})'.format(name, schema))
+
+
+def parse_revised(s, integer=False):
+    '''
+    Vectorized parsing of census number fields.
+    Revised values carry a suffix like "12345(r12400)" that is dropped,
+    and fields without data appear as "(X)", which is mapped to -1.
+    Empty fields become missing values.
+    '''
+    s = s.fillna("").astype(str)
+    numbers = pd.to_numeric(s.str.split("(", n=1).str[0].str.strip(),
+                            errors="coerce")
+    numbers = numbers.mask(s.str.contains("(X)", regex=False), -1)
+    if integer:
+        return numbers.astype("Int64")
+    return numbers
+
+
+def parse_optional(s, integer=False):
+    '''
+    Vectorized parsing of numeric fields that may be empty.
+    '''
+    numbers = pd.to_numeric(s, errors="coerce")
+    if integer:
+        return numbers.astype("Int64")
+    return numbers
+
+
+def _records(df):
+    '''
+    Converts a DataFrame into tuples of python values that sqlite3 can bind,
+    with missing values as None.
+    '''
+    values = df.astype(object)
+    values = values.where(df.notna(), None)
+    return values.itertuples(index=False, name=None)
+
+
+def bulk_insert(conn, table, frames, batch_size=10000, journal_mode='WAL',
+                synchronous='OFF', commit_every=0):
+    '''
+    Inserts every row of frames into table.
+
+    :param frames: a DataFrame or an iterable of DataFrames (e.g. the chunks
+                   of pd.read_csv(..., chunksize=n)) with columns in table order
+    :param batch_size: number of rows passed to each executemany call
+    :param commit_every: commit after every N batches, so that an interrupted
+                         load keeps its progress; 0 uses a single transaction
+    :returns: number of rows inserted
+    '''
+    if isinstance(frames, pd.DataFrame):
+        frames = [frames]
+
+    c = conn.cursor()
+    c.execute('PRAGMA journal_mode = {}'.format(journal_mode))
+    c.execute('PRAGMA synchronous = {}'.format(synchronous))
+
+    start = time()
+    n_rows = 0
+    n_batches = 0
+    sql = None
+    try:
+        c.execute('BEGIN')
+        for df in frames:
+            if sql is None:
+                sql = 'INSERT INTO {} VALUES ({})'.format(
+                    table, ', '.join(['?'] * len(df.columns)))
+            for i in range(0, len(df), batch_size):
+                c.executemany(sql, _records(df.iloc[i:i + batch_size]))
+                n_rows += min(batch_size, len(df) - i)
+                n_batches += 1
+
+                if commit_every and n_batches % commit_every == 0:
+                    c.execute('COMMIT')
+                    elapsed = time() - start
+                    print("Committed {} rows to {} ({:.0f} rows/sec)".format(
+                        n_rows, table, n_rows / elapsed if elapsed else 0))
+                    c.execute('BEGIN')
+        c.execute('COMMIT')
+    finally:
+        if conn.in_transaction:
+            c.execute('ROLLBACK')
+        # Restore durable settings for anyone using the database afterwards
+        c.execute('PRAGMA synchronous = FULL')
+        c.execute('PRAGMA journal_mode = DELETE')
+
+    elapsed = time() - start
+    print("Inserted {} rows into {} in {:.1f}s ({:.0f} rows/sec)".format(
+        n_rows, table, elapsed, n_rows / elapsed if elapsed else 0))
+    return n_rows
+
+
+# ———————————————————————————————————
+# Population Dataset
+
+POPULATION_SCHEMA = '''
+    state varchar(100),
+    target_geo_id_1 varchar(100) primary key,
+    target_geo_id_2 int,
+    geographic_area varchar(100),
+    total_population int,
+    housing_units int,
+    total_square_miles float,
+    water_square_miles float,
+    land_square_miles float,
+    land_population_density float,
+    housing_population_density float
+'''
+
+
+def read_population(path):
+    '''
+    Reads the census population csv.
+    :returns: DataFrame in the column order of the population table
+    '''
+    # the first two rows are titles of what the data contains
+    raw = pd.read_csv(path, header=None, skiprows=2, dtype=str,
+                      keep_default_na=False)
+    return pd.DataFrame({
+        "state": raw[2],
+        "target_geo_id_1": raw[3],
+        "target_geo_id_2": parse_revised(raw[4], integer=True),
+        "geographic_area": raw[6],
+        "total_population": parse_revised(raw[7], integer=True),
+        "housing_units": parse_revised(raw[8], integer=True),
+        "total_square_miles": parse_revised(raw[9]),
+        "water_square_miles": parse_revised(raw[10]),
+        "land_square_miles": parse_revised(raw[11]),
+        "land_population_density": parse_revised(raw[12]),
+        "housing_population_density": parse_revised(raw[13]),
+    })
+
+
+# ———————————————————————————————————
+# Housing Dataset
+
+HOUSING_MONTHLY_SCHEMA = '''
+    city varchar(100),
+    state varchar(100),
+    county varchar(100),
+    year int,
+    month int,
+    price int
+'''
+
+HOUSING_MONTHLY_INDEX = '''
+    CREATE INDEX housing_monthly_state_city_date
+    ON housing_monthly(state, city, year, month)
+'''
+
+
+def melt_monthly(prices):
+    '''
+    Vectorized wide-to-long reshape of the Zillow monthly price columns.
+    :param prices: DataFrame whose columns are "YYYY-MM" labels
+    :returns: (row, year, month, price) numpy arrays with one entry per
+              non-missing price, where row is the position of the source row
+    '''
+    dates = pd.to_datetime(prices.columns, format="%Y-%m")
+    n_rows, n_months = prices.shape
+
+    values = prices.to_numpy(dtype="float64").ravel()
+    rows = np.repeat(np.arange(n_rows), n_months)
+    years = np.tile(dates.year.to_numpy(dtype="int64"), n_rows)
+    months = np.tile(dates.month.to_numpy(dtype="int64"), n_rows)
+
+    keep = ~np.isnan(values)
+    return rows[keep], years[keep], months[keep], values[keep].astype("int64")
+
+
+def read_housing_monthly(path):
+    '''
+    Reads the Zillow city csv into one row per city and month.
+    :returns: DataFrame in the column order of the housing_monthly table
+    '''
+    raw = pd.read_csv(path, header=0)
+    # the first six columns are "RegionID", "RegionName", "State", "Metro",
+    # "CountyName", "SizeRank", the rest are monthly prices
+    rows, years, months, prices = melt_monthly(raw.iloc[:, 6:])
+
+    def names(i):
+        return cleaning.strip_special_series(
+            raw.iloc[:, i].fillna("").astype(str)).to_numpy()[rows]
+
+    return pd.DataFrame({
+        "city": names(1),
+        "state": names(2),
+        "county": names(4),
+        "year": years,
+        "month": months,
+        "price": prices,
+    })
+
+
+# ———————————————————————————————————
+# GV Dataset
+
+GUNVIOLENCE_SCHEMA = '''
+    incident_id int primary key,
+    date varchar(100) ,
+    state varchar(100),
+    city_or_county varchar(100),
+    address varchar(100),
+    n_killed int,
+    n_injured int,
+    incident_url varchar(10000),
+    source_url varchar(10000),
+    incident_url_fields_missing bool,
+    congressional_district int
+    gun_stolen varchar(10000),
+    gun_type varchar(10000),
+    incident_characteristics varchar(10000),
+    latitude float,
+    location_description varchar(10000),
+    longitude float,
+    n_guns_involved int,
+    notes varchar(10000),
+    participant_age varchar(10000),
+    participant_age_group varchar(10000),
+    participant_gender varchar(10000),
+    participant_name varchar(10000),
+    participant_relationship varchar(10000),
+    participant_status varchar(10000),
+    participant_type varchar(10000),
+    sources varchar(10000),
+    state_house_district int,
+    state_senate_district int
+'''
+
+# positions of the csv columns that are stored as numbers
+GUNVIOLENCE_INT_COLUMNS = [0, 5, 6, 10, 17]
+GUNVIOLENCE_FLOAT_COLUMNS = [14, 16]
+
+
+def _gunviolence_frame(raw):
+    # the table has one column fewer than the csv, see GUNVIOLENCE_SCHEMA
+    data = raw.iloc[:, :28].copy()
+    for i in GUNVIOLENCE_INT_COLUMNS:
+        col = data.columns[i]
+        data[col] = parse_optional(data[col], integer=True)
+    for i in GUNVIOLENCE_FLOAT_COLUMNS:
+        col = data.columns[i]
+        data[col] = parse_optional(data[col])
+    return data
+
+
+def read_gunviolence(path, chunksize=100000, skip=0):
+    '''
+    Reads the gunviolence csv in chunks.
+    :param skip: number of data rows to skip at the start of the file
+    :returns: generator of DataFrames in the column order of the gunviolence table
+    '''
+    reader = pd.read_csv(path, header=0, dtype=str, keep_default_na=False,
+                         skiprows=range(1, skip + 1), chunksize=chunksize)
+    for raw in reader:
+        yield _gunviolence_frame(raw)
+
+
+# ———————————————————————————————————
+# Participants and guns of the GV Dataset
+
+PARTICIPANT_FIELDS = ['age', 'age_group', 'gender', 'name', 'relationship',
+                      'status', 'type']
+GUN_FIELDS = ['stolen', 'type']
+
+PARTICIPANTS_SCHEMA = '''
+    incident_id int,
+    participant_idx int,
+    age int,
+    age_group varchar(100),
+    gender varchar(100),
+    name varchar(10000),
+    relationship varchar(10000),
+    status varchar(10000),
+    type varchar(100)
+'''
+
+PARTICIPANTS_INDEX = '''
+    CREATE INDEX participants_incident
+    ON participants(incident_id, participant_idx)
+'''
+
+GUNS_SCHEMA = '''
+    incident_id int,
+    gun_idx int,
+    stolen varchar(100),
+    type varchar(100)
+'''
+
+GUNS_INDEX = '''
+    CREATE INDEX guns_incident
+    ON guns(incident_id, gun_idx)
+'''
+
+
+def incident_ids(df):
+    '''
+    :returns: the incident_id column of df, or the ids taken from the
+              incident URLs (".../incident/123") if it has none
+    '''
+    if 'incident_id' in df.columns:
+        return parse_optional(df['incident_id'], integer=True)
+    ids = df['incident_url'].astype(str).str.extract(r'/incident/(\d+)',
+                                                     expand=False)
+    return parse_optional(ids, integer=True)
+
+
+def explode_encoded(df, prefix, fields, idx_column):
+    '''
+    Vectorized decoding of the columns that d_stage2 encodes with
+    _stringify_dict, e.g. "0::Adult 18+||1::Teen 12-17".
+    :param prefix: "participant_" or "gun_"
+    :param fields: the columns to decode, without the prefix
+    :param idx_column: name of the column of the index within the incident
+    :returns: DataFrame with one row per participant or gun and the columns
+              incident_id, idx_column and fields, in the order of df
+    '''
+    df = df.reset_index(drop=True)
+    decoded = {}
+    for field in fields:
+        col = prefix + field
+        if col not in df.columns:
+            continue
+        values = df[col].dropna().astype(str)
+        items = values[values != ""].str.split("||", regex=False).explode()
+        if items.empty:
+            continue
+        pairs = items.str.split("::", n=1, expand=True).reindex(columns=[0, 1])
+        idx = pd.to_numeric(pairs[0], errors="coerce")
+        keep = idx.notna().to_numpy()
+        key = pd.MultiIndex.from_arrays(
+            [items.index[keep], idx[keep].astype("int64")],
+            names=["row", idx_column])
+        series = pd.Series(pairs[1].to_numpy()[keep], index=key)
+        decoded[field] = series[~series.index.duplicated()]
+
+    if not decoded:
+        return pd.DataFrame(columns=["incident_id", idx_column, *fields])
+
+    # fields missing from df are left empty
+    table = pd.concat(decoded, axis=1).reindex(columns=fields).astype(object)
+    table = table.sort_index().reset_index()
+    rows = table.pop("row").to_numpy()
+    table.insert(0, "incident_id", incident_ids(df).array.take(rows))
+    return table
+
+
+def explode_participants(df):
+    '''
+    :returns: DataFrame in the column order of the participants table
+    '''
+    table = explode_encoded(df, "participant_", PARTICIPANT_FIELDS,
+                            "participant_idx")
+    table["age"] = parse_optional(table["age"], integer=True)
+    return table
+
+
+def explode_guns(df):
+    '''
+    :returns: DataFrame in the column order of the guns table
+    '''
+    return explode_encoded(df, "gun_", GUN_FIELDS, "gun_idx")
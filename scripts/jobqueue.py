@@ -0,0 +1,166 @@
+'''
+Persistent queue of the work of a scraping stage, stored in SQLite.
+
+Every job (a date window of stage 1, an incident of stage 2) is a row with a
+state: pending, in_flight, done or failed. Workers claim pending jobs, which
+become in flight for a lease period, and record them as done with their
+result, or as failed. Jobs whose lease ran out, e.g. because their worker
+crashed, are claimed again, so a stage that is killed and restarted picks up
+exactly the remaining work. A job whose lease ran out max_attempts times, e.g.
+because it crashes its worker, is marked failed instead. Several processes can
+share one queue file.
+'''
+
+import json
+import sqlite3
+import time
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+STATES = [PENDING, IN_FLIGHT, DONE, FAILED]
+
+# Seconds a claimed job stays reserved to its worker
+LEASE_SECONDS = 600
+
+# Number of times a job is claimed before a lease running out marks it failed
+MAX_ATTEMPTS = 3
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS "jobs" (
+    "id" INTEGER PRIMARY KEY,
+    "key" TEXT NOT NULL UNIQUE,
+    "payload" TEXT,
+    "state" TEXT NOT NULL,
+    "attempts" INTEGER NOT NULL DEFAULT 0,
+    "leased_until" REAL,
+    "result" TEXT,
+    "error" TEXT
+);'''
+
+INDEX = 'CREATE INDEX IF NOT EXISTS "jobs_state" ON "jobs" ("state", "id");'
+
+
+class JobQueue(object):
+    '''
+    Jobs are identified by a unique key and handed out in the order they were added.
+    Payloads and results are stored as JSON.
+
+    The SQLite connection is opened on first use, so a JobQueue can be passed to worker processes.
+    '''
+
+    def __init__(self, fname, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.fname = fname
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._conn = None
+
+    def __getstate__(self):
+        return {**self.__dict__, '_conn': None}
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.fname, timeout=60, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode = WAL;')
+            self._conn.execute(SCHEMA)
+            self._conn.execute(INDEX)
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def add(self, jobs) -> int:
+        '''
+        Adds jobs to the queue. Jobs whose key is already in the queue keep their state.
+        :param jobs: iterable of (key, payload) pairs
+        :returns: number of new jobs
+        '''
+        before = self.conn.total_changes
+        self.conn.execute('BEGIN')
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO jobs (key, payload, state) VALUES (?, ?, ?)',
+            ((key, json.dumps(payload), PENDING) for key, payload in jobs))
+        self.conn.execute('COMMIT')
+        return self.conn.total_changes - before
+
+    def claim(self, n=1) -> list:
+        '''
+        Reserves up to n pending jobs, or in-flight jobs whose lease ran out.
+        In-flight jobs whose lease ran out for the max_attempts-th time are marked failed.
+        :returns: list of (key, payload) pairs, empty when no job is left to claim
+        '''
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.execute(
+                "UPDATE jobs SET state = ?, error = 'lease expired ' || attempts || ' times', \
+                leased_until = NULL \
+                WHERE state = ? AND leased_until < ? AND attempts >= ?",
+                (FAILED, IN_FLIGHT, now, self.max_attempts))
+            rows = self.conn.execute(
+                'SELECT id, key, payload FROM jobs \
+                WHERE state = ? OR (state = ? AND leased_until < ?) \
+                ORDER BY id LIMIT ?',
+                (PENDING, IN_FLIGHT, now, n)).fetchall()
+            self.conn.executemany(
+                'UPDATE jobs SET state = ?, leased_until = ?, attempts = attempts + 1 WHERE id = ?',
+                ((IN_FLIGHT, now + self.lease_seconds, row[0]) for row in rows))
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return [(key, json.loads(payload)) for _, key, payload in rows]
+
+    def done(self, key, result=None) -> None:
+        self.conn.execute(
+            'UPDATE jobs SET state = ?, result = ?, error = NULL, leased_until = NULL WHERE key = ?',
+            (DONE, json.dumps(result), key))
+
+    def failed(self, key, error) -> None:
+        self.conn.execute(
+            'UPDATE jobs SET state = ?, error = ?, leased_until = NULL WHERE key = ?',
+            (FAILED, str(error), key))
+
+    def retry_failed(self) -> int:
+        '''
+        Puts the failed jobs back in the queue, with their attempts reset.
+        :returns: number of jobs requeued
+        '''
+        return self.conn.execute(
+            'UPDATE jobs SET state = ?, attempts = 0 WHERE state = ?', (PENDING, FAILED)).rowcount
+
+    def get(self, key):
+        '''
+        :returns: (state, result) of a job
+        '''
+        state, result = self.conn.execute(
+            'SELECT state, result FROM jobs WHERE key = ?', (key,)).fetchone()
+        return state, json.loads(result) if result is not None else None
+
+    def results(self):
+        '''
+        :returns: generator of (key, result) of the done jobs, in the order they were added
+        '''
+        for key, result in self.conn.execute(
+                'SELECT key, result FROM jobs WHERE state = ? ORDER BY id', (DONE,)):
+            yield key, json.loads(result)
+
+    def counts(self) -> dict:
+        '''
+        :returns: number of jobs in each state
+        '''
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+        return counts
+
+    def is_finished(self) -> bool:
+        counts = self.counts()
+        return counts[PENDING] == 0 and counts[IN_FLIGHT] == 0
+
+    def print_counts(self) -> None:
+        print('Queue {}: {pending} pending, {in_flight} in flight, {done} done, {failed} failed'.format(
+            self.fname, **self.counts()))
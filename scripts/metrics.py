@@ -0,0 +1,176 @@
+'''
+Throughput metrics of the scraping stages.
+
+A Metrics object accumulates time spent per step (fetch, parse, extract,
+normalize, write...), counts of pages and incidents, errors by type and the
+depth of the work queue. Every `interval` seconds, report() emits a JSON line
+with the totals, the rolling rates and the ETA; summary() emits the final one.
+
+Worker processes keep their own Metrics and send snapshot() to the parent,
+which merge()s them. Threads can share one Metrics.
+'''
+
+import json
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+# Seconds between two JSON lines
+INTERVAL = 10
+
+# Rates are computed over this many seconds
+ROLLING_SECONDS = 60
+
+
+class Metrics(object):
+    '''
+    :param stage: name of the stage, included in every line
+    :param total: number of `unit` items to process, for the ETA
+    :param unit: counter the ETA is based on, e.g. 'incidents'
+    :param fname: file the JSON lines are appended to, stdout if None
+    '''
+
+    def __init__(self, stage=None, total=None, unit='incidents', fname=None, interval=INTERVAL):
+        self.stage = stage
+        self.total = total
+        self.unit = unit
+        self.fname = fname
+        self.interval = interval
+
+        self.started = time.time()
+        self.timers = Counter()
+        self.counters = Counter()
+        self.errors = Counter()
+        self.queue_depth = None
+
+        self._events = deque()
+        self._last_report = self.started
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        # Locks cannot be pickled, e.g. to send a Metrics to the workers of a pool.
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    # —————
+    # Recording
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timers[name] += elapsed
+
+    def count(self, name, n=1) -> None:
+        with self._lock:
+            self.counters[name] += n
+            self._events.append((time.time(), name, n))
+
+    def error(self, ex) -> None:
+        with self._lock:
+            self.errors[type(ex).__name__] += 1
+
+    def set_queue_depth(self, n) -> None:
+        with self._lock:
+            self.queue_depth = n
+
+    def snapshot(self, reset=True) -> dict:
+        '''
+        :param reset: start counting from zero again, so that snapshots can be merged as deltas
+        :returns: picklable totals recorded since the last reset
+        '''
+        with self._lock:
+            snapshot = {
+                'timers': dict(self.timers),
+                'counters': dict(self.counters),
+                'errors': dict(self.errors),
+            }
+            if reset:
+                self.timers.clear()
+                self.counters.clear()
+                self.errors.clear()
+                self._events.clear()
+        return snapshot
+
+    def merge(self, snapshot) -> None:
+        with self._lock:
+            self.timers.update(snapshot['timers'])
+            self.errors.update(snapshot['errors'])
+            for name, n in snapshot['counters'].items():
+                self.count(name, n)
+
+    # —————
+    # Reporting
+
+    def rate(self, name) -> float:
+        '''
+        :returns: per second rate of a counter over the last ROLLING_SECONDS
+        '''
+        now = time.time()
+        with self._lock:
+            while self._events and self._events[0][0] < now - ROLLING_SECONDS:
+                self._events.popleft()
+            n = sum(count for _, event_name, count in self._events if event_name == name)
+        window = min(ROLLING_SECONDS, now - self.started)
+        return n / window if window > 0 else 0.0
+
+    def eta(self):
+        '''
+        :returns: seconds left at the current rate, or None if unknown
+        '''
+        with self._lock:
+            rate = self.rate(self.unit)
+            if self.total is None or rate == 0:
+                return None
+            return max(0, self.total - self.counters[self.unit]) / rate
+
+    def to_dict(self, event) -> dict:
+        with self._lock:
+            eta = self.eta()
+            return {
+                'event': event,
+                'stage': self.stage,
+                'time': round(time.time(), 3),
+                'elapsed': round(time.time() - self.started, 3),
+                'timers': {name: round(seconds, 3) for name, seconds in self.timers.items()},
+                'counters': dict(self.counters),
+                'rates': {name: round(self.rate(name), 3) for name in self.counters},
+                'errors': dict(self.errors),
+                'queue_depth': self.queue_depth,
+                'total': self.total,
+                'eta': round(eta) if eta is not None else None,
+            }
+
+    def _emit(self, event) -> None:
+        line = json.dumps(self.to_dict(event))
+        if self.fname is None:
+            print(line)
+            sys.stdout.flush()
+        else:
+            with open(self.fname, 'a') as f:
+                f.write(line + '\n')
+
+    def report(self, force=False) -> None:
+        '''
+        Emits a progress line if `interval` seconds passed since the last one.
+        '''
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_report < self.interval:
+                return
+            self._last_report = now
+        self._emit('progress')
+
+    def summary(self) -> None:
+        self._emit('summary')
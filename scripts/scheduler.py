@@ -0,0 +1,198 @@
+'''
+Rate limiting and retrying of the requests made by the scraping stages.
+
+A Scheduler spaces requests out to a requests-per-second budget that is
+shared by every worker process it is handed to (through a Pool initializer),
+retries failed requests with exponential backoff and jitter, and lowers the
+rate when the server answers 429 or 5xx. It works from both plain and asyncio
+code.
+'''
+
+import asyncio
+import multiprocessing as mp
+import random
+import time
+
+# The rate is divided by this on every 429/5xx response...
+SLOW_DOWN_FACTOR = 2.0
+# ...and climbs back up by this fraction of the initial rate on every success.
+SPEED_UP_STEP = 0.05
+
+MAX_RETRIES = 3
+BACKOFF_BASE = 2.0  # seconds
+BACKOFF_MAX = 60.0  # seconds
+
+
+def is_throttled(status) -> bool:
+    '''
+    :returns: whether an HTTP status means the server is overloaded or limiting us
+    '''
+    return status is not None and (status == 429 or status >= 500)
+
+
+class Scheduler(object):
+    '''
+    :param rps: initial requests per second, shared by all processes. 0 disables the limit.
+    :param min_rps: lowest rate it slows down to
+    :param retry_on: exception types worth retrying. Exceptions with an HTTP `status`
+        attribute (e.g. aiohttp's ClientResponseError) are retried on 429/5xx only.
+    :param max_retries: retries of a request before giving up on it
+    '''
+
+    def __init__(self, rps, min_rps=None, retry_on=(OSError, asyncio.TimeoutError),
+                 max_retries=MAX_RETRIES):
+        self.max_rps = rps
+        self.min_rps = min_rps if min_rps is not None else rps / 16
+        self.retry_on = retry_on
+        self.max_retries = max_retries
+
+        self._lock = mp.Lock()
+        self._rate = mp.Value('d', rps, lock=False)
+        self._next_slot = mp.Value('d', 0.0, lock=False)
+        self._started = mp.Value('d', time.time(), lock=False)
+        self._ok = mp.Value('q', 0, lock=False)
+        self._retried = mp.Value('q', 0, lock=False)
+        self._failed = mp.Value('q', 0, lock=False)
+        self._requeued = mp.Value('q', 0, lock=False)
+
+    # —————
+    # Rate limiting
+
+    def reserve(self) -> float:
+        '''
+        Books the next free request slot.
+        :returns: number of seconds to wait before making the request
+        '''
+        if not self.max_rps:
+            return 0.0
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot.value)
+            self._next_slot.value = slot + 1 / self._rate.value
+        return slot - now
+
+    def wait(self) -> None:
+        time.sleep(self.reserve())
+
+    async def wait_async(self) -> None:
+        await asyncio.sleep(self.reserve())
+
+    def slow_down(self) -> None:
+        with self._lock:
+            self._rate.value = max(self.min_rps, self._rate.value / SLOW_DOWN_FACTOR)
+
+    def _speed_up(self) -> None:
+        with self._lock:
+            self._rate.value = min(self.max_rps, self._rate.value + self.max_rps * SPEED_UP_STEP)
+
+    # —————
+    # Retrying
+
+    def is_transient(self, ex) -> bool:
+        '''
+        :returns: whether a request that raised ex is worth trying again later
+        '''
+        status = getattr(ex, 'status', None)
+        if status is not None:
+            return is_throttled(status)
+        return isinstance(ex, self.retry_on)
+
+    def _backoff(self, attempt, ex) -> float:
+        '''
+        Exponential backoff with full jitter, or the Retry-After delay asked by the server.
+        '''
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        headers = getattr(ex, 'headers', None) or {}
+        retry_after = headers.get('Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        return delay
+
+    def _on_error(self, attempt, ex):
+        '''
+        :returns: seconds to wait before retrying, or None to give up
+        '''
+        if is_throttled(getattr(ex, 'status', None)):
+            self.slow_down()
+        if attempt >= self.max_retries or not self.is_transient(ex):
+            self._count(self._failed)
+            return None
+        self._count(self._retried)
+        return self._backoff(attempt, ex)
+
+    def _on_success(self):
+        self._count(self._ok)
+        if self._rate.value < self.max_rps:
+            self._speed_up()
+
+    def run(self, fn, *args, **kwargs):
+        '''
+        Calls fn(*args, **kwargs) in the next request slot, retrying it on failure.
+        The last exception is raised when all retries failed.
+        '''
+        attempt = 0
+        while True:
+            self.wait()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as ex:
+                delay = self._on_error(attempt, ex)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._on_success()
+            return result
+
+    async def run_async(self, fn, *args, **kwargs):
+        '''
+        Same as run, for a coroutine function fn.
+        '''
+        attempt = 0
+        while True:
+            await self.wait_async()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as ex:
+                delay = self._on_error(attempt, ex)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self._on_success()
+            return result
+
+    # —————
+    # Counters
+
+    def _count(self, counter, n=1) -> None:
+        with self._lock:
+            counter.value += n
+
+    def requeued(self) -> None:
+        '''
+        Counts a request that failed for good and was put back at the end of its work queue.
+        Its earlier failure is no longer counted as failed.
+        '''
+        with self._lock:
+            self._requeued.value += 1
+            self._failed.value -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            elapsed = time.time() - self._started.value
+            ok = self._ok.value
+            return {
+                'ok': ok,
+                'retried': self._retried.value,
+                'requeued': self._requeued.value,
+                'failed': self._failed.value,
+                'rps': self._rate.value,
+                'effective_rps': ok / elapsed if elapsed > 0 else 0.0,
+            }
+
+    def print_stats(self) -> None:
+        print('{ok} ok, {retried} retried, {requeued} requeued, {failed} failed, '
+              'rate {rps:.2f} req/s, effective {effective_rps:.2f} req/s'.format(**self.stats()))
@@ -4,24 +4,32 @@
 import asyncio
 import dateutil.parser as dateparser
 import logging as log
+import os
 import platform
 import sys
 import warnings
 
+import html_parsing
+import http_cache
+import jobqueue
 import selenium_utils
+import stage_io
 
 from argparse import ArgumentParser
 from calendar import monthrange
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
 from functools import partial
-from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException, WebDriverException
 from selenium.webdriver import Chrome
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 from urllib.parse import parse_qs, urlparse
 
-from stage1_serializer import Stage1Serializer
+from metrics import INTERVAL as METRICS_INTERVAL, Metrics
+from scheduler import MAX_RETRIES, Scheduler
+from stage1_serializer import CONCURRENCY, RETRY_ON, Stage1Serializer
 
 # Formats as %m/%d/%Y, but does not leave leading zeroes on the month or day.
 # Surprisingly, the syntax for this is different across platforms: https://stackoverflow.com/a/2073189/4077294
@@ -29,6 +37,21 @@ DATE_FORMAT = '%#m/%#d/%Y' if platform.system() == 'Windows' else '%-m/%-d/%Y'
 
 MESSAGE_NO_INCIDENTS_AVAILABLE = 'There are currently no incidents available.'
 
+# Requests per second to the site, for the queries and the result pages.
+RPS = 2.0
+
+# Browser sessions running queries at once
+SESSIONS = 2
+
+# Query windows are sized to return about TARGET_PAGES result pages, from one day up to
+# MAX_WINDOW_DAYS. A window of several days returning more than MAX_PAGES pages is split.
+TARGET_PAGES = 10
+MAX_PAGES = 50
+MAX_WINDOW_DAYS = 31
+
+# Seconds between two looks at the job queue for the next finished day
+QUEUE_POLL_SECONDS = 1
+
 
 def parse_args():
     targets_specific_month = False
@@ -55,7 +78,7 @@ def parse_args():
         parser.add_argument(
             'output_file',
             metavar='OUTFILE',
-            help="set output file",
+            help="set output file (.csv, .parquet or .feather)",
             action='store',
         )
 
@@ -67,6 +90,71 @@ def parse_args():
         const=log.DEBUG,
         default=log.WARNING,
     )
+    parser.add_argument(
+        '--rps',
+        help="requests per second, 0 for no limit. Lowered automatically on 429/5xx responses "
+             "(default: {})".format(RPS),
+        type=float,
+        default=RPS,
+    )
+    parser.add_argument(
+        '--max-retries',
+        help="retries of a failed query or page download (default: {})".format(MAX_RETRIES),
+        type=int,
+        default=MAX_RETRIES,
+    )
+    parser.add_argument(
+        '--cache-dir',
+        help="directory of the cache of result pages (default: {})".format(http_cache.CACHE_DIR),
+        default=http_cache.CACHE_DIR,
+    )
+    parser.add_argument(
+        '--queue',
+        metavar='QUEUE',
+        help="track the days queried in this SQLite job queue, so that the run can be resumed "
+             "after a crash. Days are then queried one at a time",
+        dest='queue_fname',
+    )
+    parser.add_argument(
+        '--retry-failed',
+        help="with --queue, query the days that failed in earlier runs again",
+        action='store_true',
+    )
+    parser.add_argument(
+        '--sessions',
+        help="browser sessions querying parts of the date range at once (default: {})".format(SESSIONS),
+        type=int,
+        default=SESSIONS,
+    )
+    parser.add_argument(
+        '--concurrency',
+        help="result pages downloaded at once (default: {})".format(CONCURRENCY),
+        type=int,
+        default=CONCURRENCY,
+    )
+    parser.add_argument(
+        '--parser',
+        help="HTML parser backend (default: {})".format(html_parsing.DEFAULT_BACKEND),
+        choices=html_parsing.BACKENDS,
+        default=html_parsing.DEFAULT_BACKEND,
+    )
+    parser.add_argument(
+        '--no-cache',
+        help="always download the result pages, and do not store them in the cache",
+        action='store_true',
+    )
+    parser.add_argument(
+        '--metrics',
+        metavar='FILE',
+        help="append the progress metrics (JSON lines) to this file instead of printing them",
+        dest='metrics_fname',
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        help="seconds between two progress lines (default: {})".format(METRICS_INTERVAL),
+        type=float,
+        default=METRICS_INTERVAL,
+    )
 
     args = parser.parse_args()
     if targets_specific_month:
@@ -133,23 +221,197 @@ def get_n_pages(driver):
         return 1
 
 
+def split_range(start, end, n):
+    '''
+    Splits the days from start to end (inclusive) into at most n contiguous segments of about the
+    same length.
+    :returns: list of (start, end) pairs, in date order
+    '''
+    n_days = (end - start).days + 1
+    n = max(1, min(n, n_days))
+    bounds = [start + timedelta(days=n_days * i // n) for i in range(n + 1)]
+    return [(bounds[i], bounds[i + 1] - timedelta(days=1)) for i in range(n)]
+
+
+def next_window_days(days, n_pages):
+    '''
+    :returns: number of days of the next query window, given the number of result pages of the
+        last window of `days` days
+    '''
+    if n_pages == 0:
+        return min(MAX_WINDOW_DAYS, days * 2)
+    return max(1, min(MAX_WINDOW_DAYS, days * TARGET_PAGES // n_pages))
+
+
+def query_segment(scheduler, start, end, emit, metrics=None):
+    '''
+    Queries the incidents from start to end (inclusive) with a browser session of its own, one
+    window at a time: quiet ranges are queried in wider windows, busy ones in narrower windows.
+    Calls emit(query_url, n_pages) for every window with results, in date order.
+    '''
+    metrics = metrics or Metrics()
+    driver = Chrome()
+    try:
+        days = 1
+        while start <= end:
+            window_end = min(end, start + timedelta(days=days - 1))
+            try:
+                with metrics.timer('query'):
+                    query_url, n_pages = scheduler.run(query, driver, start, window_end)
+            except Exception as ex:
+                metrics.error(ex)
+                raise
+            metrics.count('queries')
+            window_days = (window_end - start).days + 1
+            if n_pages > MAX_PAGES and window_days > 1:
+                days = window_days // 2
+                continue
+            metrics.count('days', window_days)
+            if n_pages > 0:
+                emit(query_url, n_pages)
+            days = next_window_days(window_days, n_pages)
+            start = window_end + timedelta(days=1)
+    finally:
+        driver.quit()
+
+
+def query_queue(queue, scheduler, metrics=None):
+    '''
+    Claims days from the job queue and queries them with a browser session of its own, until
+    none is left to claim. The query URL and number of result pages of a day are stored as the
+    result of its job.
+    '''
+    metrics = metrics or Metrics()
+    driver = Chrome()
+    try:
+        while True:
+            jobs = queue.claim()
+            if not jobs:
+                return
+            key, _ = jobs[0]
+            day = dateparser.parse(key)
+            try:
+                with metrics.timer('query'):
+                    query_url, n_pages = scheduler.run(query, driver, day, day)
+            except Exception as ex:
+                print(ex)
+                metrics.error(ex)
+                queue.failed(key, ex)
+                continue
+            metrics.count('queries')
+            metrics.count('days')
+            queue.done(key, [query_url, n_pages])
+    finally:
+        driver.quit()
+        queue.close()
+
+
+async def write_queue_batches(queue, keys, serializer, futures):
+    '''
+    Queues the result pages of the days in keys to the serializer, in order, as their queries
+    are done.
+    :returns: whether every day was done or failed. Days can be left if another process holds them.
+    '''
+    for key in keys:
+        while True:
+            finished = all(future.done() for future in futures)
+            state, result = queue.get(key)
+            if state == jobqueue.DONE:
+                query_url, n_pages = result
+                if n_pages > 0:
+                    await serializer.write_batch(query_url, n_pages)
+                break
+            if state == jobqueue.FAILED:
+                print('Query of {} failed, skipping it'.format(key))
+                break
+            if finished:
+                return False
+            await asyncio.sleep(QUEUE_POLL_SECONDS)
+    return True
+
+
 async def main():
     args = parse_args()
     log.basicConfig(level=args.log_level)
-    driver = Chrome()
+    loop = asyncio.get_event_loop()
 
-    step = timedelta(days=1)
     global_start, global_end = dateparser.parse(args.start_date), dateparser.parse(args.end_date)
-    start, end = global_start, global_start + step - timedelta(days=1)
+    segments = split_range(global_start, global_end, args.sessions)
 
-    async with Stage1Serializer(output_fname=args.output_file) as serializer:
-        serializer.write_header()
-        while start <= global_end:
-            query_url, n_pages = query(driver, start, end)
-            if n_pages > 0:
-                serializer.write_batch(query_url, n_pages)
-            start, end = end + timedelta(days=1), min(global_end, end + step)
-        await serializer.flush_writes()
+    # Pages are streamed to a csv, which is converted afterwards if a columnar output was requested.
+    csv_fname = args.output_file
+    if stage_io.is_columnar(args.output_file):
+        csv_fname = args.output_file + '.partial.csv'
+
+    # The queries go through the browsers and the result pages through aiohttp, under one budget.
+    scheduler = Scheduler(args.rps, retry_on=(WebDriverException, *RETRY_ON), max_retries=args.max_retries)
+
+    cache = None if args.no_cache else http_cache.HttpCache(args.cache_dir)
+
+    # The ETA is based on the days queried, since the number of incidents is not known in advance.
+    n_days = (global_end - global_start).days + 1
+    metrics = Metrics('stage1', n_days, unit='days', fname=args.metrics_fname,
+                      interval=args.metrics_interval)
+
+    def run_segment(segment, batches):
+        def emit(query_url, n_pages):
+            loop.call_soon_threadsafe(batches.put_nowait, (query_url, n_pages))
+        try:
+            query_segment(scheduler, *segment, emit, metrics)
+        finally:
+            # End of the segment
+            loop.call_soon_threadsafe(batches.put_nowait, None)
+
+    # The summary is emitted even if a query fails for good, with its error.
+    try:
+        async with Stage1Serializer(output_fname=csv_fname, scheduler=scheduler, cache=cache,
+                                    parser=args.parser, concurrency=args.concurrency,
+                                    metrics=metrics) as serializer:
+            serializer.write_header()
+
+            if args.queue_fname:
+                queue = jobqueue.JobQueue(args.queue_fname)
+                if args.retry_failed:
+                    print('Retrying {} failed days'.format(queue.retry_failed()))
+                keys = [(global_start + timedelta(days=i)).date().isoformat() for i in range(n_days)]
+                queue.add((key, None) for key in keys)
+                queue.print_counts()
+                # Days done in earlier runs are not queried again.
+                metrics.total = sum(queue.counts()[state] for state in (jobqueue.PENDING, jobqueue.IN_FLIGHT))
+
+                # Every session has its own connection to the queue.
+                with ThreadPoolExecutor(args.sessions) as executor:
+                    futures = [loop.run_in_executor(executor, query_queue, jobqueue.JobQueue(args.queue_fname),
+                                                    scheduler, metrics)
+                               for _ in range(args.sessions)]
+                    is_complete = await write_queue_batches(queue, keys, serializer, futures)
+                    await asyncio.gather(*futures)
+
+                queue.print_counts()
+                if not is_complete:
+                    print('Other workers are still querying days of the queue, rerun once they are done to complete the output.')
+            else:
+                # Each segment of the date range is queried in a thread with its own browser, while the
+                # result pages of the finished queries download. The pages are queued segment by
+                # segment, so that the output stays in date order.
+                with ThreadPoolExecutor(len(segments)) as executor:
+                    segment_batches = [asyncio.Queue() for _ in segments]
+                    futures = [loop.run_in_executor(executor, run_segment, segment, batches)
+                               for segment, batches in zip(segments, segment_batches)]
+                    for future, batches in zip(futures, segment_batches):
+                        while True:
+                            batch = await batches.get()
+                            if batch is None:
+                                break
+                            await serializer.write_batch(*batch)
+                        await future
+            await serializer.flush_writes()
+    finally:
+        metrics.summary()
+
+    if csv_fname != args.output_file:
+        stage_io.convert(csv_fname, args.output_file)
+        os.remove(csv_fname)
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
@@ -1,16 +1,29 @@
 import asyncio
 import csv
 
-from aiohttp import ClientSession
-from bs4 import BeautifulSoup
+from aiohttp import ClientError, ClientSession, TCPConnector
+
+import html_parsing
+from metrics import Metrics
+from scheduler import Scheduler
 
 GVA_DOMAIN = 'http://www.gunviolencearchive.org'
 
+# Errors worth retrying a page download for, besides 429/5xx responses.
+RETRY_ON = (ClientError, asyncio.TimeoutError)
+
+# Result pages downloaded at once
+CONCURRENCY = 4
+# Pages queued or waiting to be written, per download worker
+WINDOW_PER_WORKER = 4
+
 def _get_info(tr):
     tds = tr.select('td')
     assert len(tds) == 8
 
-    date, state, city_or_county, address, n_killed, n_injured = [td.contents[0] for td in tds[1:7]]
+    # An empty cell, e.g. an unknown address, is read as ''.
+    date, state, city_or_county, address, n_killed, n_injured = [
+        td.contents[0] if td.contents else '' for td in tds[1:7]]
     n_killed, n_injured = map(int, [n_killed, n_injured])
 
     incident_a = tds[-1].find('a', string='View Incident')
@@ -21,34 +34,156 @@ def _get_info(tr):
 
     return date, state, city_or_county, address, n_killed, n_injured, incident_url, source_url
 
+# Rows of the result table, same as the CSS selector '.responsive tbody tr'. lxml does not add
+# the <tbody> elements missing from the page like html5lib does, so header rows are told apart by
+# their lack of <td>.
+LISTING_ROWS_XPATH = '//*[{}]//tr[td]'.format(html_parsing.xpath_has_class('responsive'))
+
+def _get_info_lxml(tr):
+    '''
+    Same as _get_info, for an lxml element.
+    '''
+    tds = tr.xpath('./td')
+    assert len(tds) == 8
+
+    date, state, city_or_county, address, n_killed, n_injured = [td.text or '' for td in tds[1:7]]
+    n_killed, n_injured = map(int, [n_killed, n_injured])
+
+    incident_a = tds[-1].xpath('.//a[string()="View Incident"]')[0]
+    incident_url = GVA_DOMAIN + incident_a.get('href')
+
+    source_a = tds[-1].xpath('.//a[string()="View Source"]')
+    source_url = source_a[0].get('href') if source_a else ''
+
+    return date, state, city_or_county, address, n_killed, n_injured, incident_url, source_url
+
+def read_listing(html, backend=html_parsing.DEFAULT_BACKEND):
+    '''
+    Extracts the incidents of a result page.
+    :returns: list of rows in the format of _get_info, by ascending date
+    '''
+    if backend == 'lxml':
+        trs = html_parsing.parse_lxml(html).xpath(LISTING_ROWS_XPATH)
+        infos = [_get_info_lxml(tr) for tr in trs]
+    else:
+        soup = html_parsing.make_soup(html, backend)
+        infos = [_get_info(tr) for tr in soup.select('.responsive tbody tr')]
+    infos.reverse() # Order by ascending date instead of descending
+    return infos
+
 class Stage1Serializer(object):
-    def __init__(self, output_fname, encoding='utf-8'):
+    '''
+    Downloads the result pages of the queries and writes their incidents to a csv file.
+
+    Pages are downloaded by `concurrency` workers while the next queries are still running.
+    They are written as soon as every page queued before them is, so the output keeps the order
+    of the write_batch calls (ascending date), and at most `window` pages are held in memory.
+
+    Timings, page and incident counts and errors are recorded in `metrics`, which reports the
+    progress as pages are written.
+    '''
+
+    def __init__(self, output_fname, encoding='utf-8', scheduler=None, cache=None,
+                 parser=html_parsing.DEFAULT_BACKEND, concurrency=CONCURRENCY, window=None,
+                 metrics=None):
         self._output_fname = output_fname
         self._encoding = encoding
-        self._page_urls = []
+        # No rate limit by default
+        self._scheduler = scheduler or Scheduler(0, retry_on=RETRY_ON)
+        # Optional http_cache.HttpCache of the result pages
+        self._cache = cache
+        self._parser = parser
+        self._concurrency = concurrency
+        self._window = window or WINDOW_PER_WORKER * concurrency
+        self._metrics = metrics or Metrics()
+
+        # Pages are numbered in the order they are queued.
+        self._n_pages = 0
+        self._next_page = 0
+        # Rows of the pages that finished before an earlier page, by page number
+        self._done = {}
+        self._requeued = set()
 
     async def __aenter__(self):
         self._output_file = open(self._output_fname, 'w', encoding=self._encoding)
         self._writer = csv.writer(self._output_file)
-        self._sess = await ClientSession().__aenter__()
+        self._sess = await ClientSession(connector=TCPConnector(limit=self._concurrency)).__aenter__()
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self._window)
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(self._concurrency)]
         return self
 
     async def __aexit__(self, type, value, tb):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
         self._output_file.__exit__(type, value, tb)
         await self._sess.__aexit__(type, value, tb)
 
-    async def _gettext(self, url):
+    async def _get(self, url):
         async with self._sess.get(url) as resp:
+            resp.raise_for_status()
             return await resp.text()
 
-    async def _write_page(self, page_url):
+    async def _gettext(self, url):
+        if self._cache is not None:
+            text = self._cache.get(url)
+            if text is not None:
+                self._metrics.count('cache_hits')
+                return text
+
+        with self._metrics.timer('fetch'):
+            text = await self._scheduler.run_async(self._get, url)
+        self._metrics.count('pages')
+        if self._cache is not None:
+            self._cache.put(url, text)
+        return text
+
+    async def _read_page(self, page_url):
         text = await self._gettext(page_url)
-        soup = BeautifulSoup(text, features='html5lib')
-        trs = soup.select('.responsive tbody tr')
-        trs = reversed(trs) # Order by ascending date instead of descending
-        infos = map(_get_info, trs)
-        for info in infos:
-            self._writer.writerow([*info])
+        with self._metrics.timer('parse'):
+            return read_listing(text, self._parser)
+
+    async def _work(self):
+        while True:
+            page_no, page_url = await self._queue.get()
+            try:
+                rows = await self._read_page(page_url)
+            except Exception as ex:
+                self._metrics.error(ex)
+                if page_no not in self._requeued and self._scheduler.is_transient(ex):
+                    # Try again once the pages queued so far are done.
+                    self._requeued.add(page_no)
+                    self._scheduler.requeued()
+                    self._queue.put_nowait((page_no, page_url))
+                    self._queue.task_done()
+                    continue
+                print(page_url)
+                print(ex)
+                rows = None
+
+            try:
+                self._done[page_no] = rows
+                self._write_ready_pages()
+                self._metrics.set_queue_depth(self._queue.qsize())
+                self._metrics.report()
+            finally:
+                self._queue.task_done()
+
+    def _raise_worker_error(self):
+        for worker in self._workers:
+            if worker.done() and not worker.cancelled() and worker.exception() is not None:
+                raise worker.exception()
+
+    def _write_ready_pages(self):
+        while self._next_page in self._done:
+            rows = self._done.pop(self._next_page)
+            if rows:
+                with self._metrics.timer('write'):
+                    self._writer.writerows(rows)
+                self._metrics.count('incidents', len(rows))
+            self._next_page += 1
+            self._slots.release()
 
     def write_header(self):
         self._writer.writerow([
@@ -62,14 +197,29 @@ class Stage1Serializer(object):
             'source_url'
         ])
 
-    def write_batch(self, query_url, n_pages):
+    async def write_batch(self, query_url, n_pages):
+        '''
+        Queues the result pages of a query. Waits while `window` pages are already pending.
+        '''
         batch = ['{}?page={}'.format(query_url, pageno) for pageno in range(n_pages - 1, 0, -1)] + [query_url]
-        self._page_urls.extend(batch)
+        for page_url in batch:
+            self._raise_worker_error()
+            await self._slots.acquire()
+            self._queue.put_nowait((self._n_pages, page_url))
+            self._n_pages += 1
 
     async def flush_writes(self):
+        '''
+        Waits until every queued page is written.
+        '''
         print("Flushing writes made to serializer")
-
-        tasks = (self._write_page(url) for url in self._page_urls)
-        # TODO: This is totally screwing up the order. Who cares though because the perf improvement is amazing.
-        # (If you care about the order, sort the data yourself after loading it in.)
-        return await asyncio.gather(*tasks)
+        joined = asyncio.ensure_future(self._queue.join())
+        # Stop as soon as a worker dies, e.g. on a failed write, instead of waiting on the others.
+        await asyncio.wait([joined, *self._workers], return_when=asyncio.FIRST_COMPLETED)
+        joined.cancel()
+        self._raise_worker_error()
+        self._output_file.flush()
+
+        self._scheduler.print_stats()
+        if self._cache is not None:
+            self._cache.print_stats()
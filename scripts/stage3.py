@@ -1,48 +1,254 @@
 #!/usr/bin/env python3
 # stage 3: sorting and merging data
 
-import numpy as np
+import hashlib
+import heapq
+import json
+import os
 import pandas as pd
 
+from argparse import ArgumentParser
 from glob import glob
+from tempfile import TemporaryDirectory
 
-STAGE2_GLOB = 'stage2.*.csv'
+import stage_io
 
-SCHEMA = {
-    'congressional_district': np.float64,
-    'state_house_district': np.float64,
-    'state_senate_district': np.float64,
-    'n_guns_involved': np.float64,
-}
+STAGE2_GLOBS = ['stage2.*' + ext for ext in stage_io.EXTENSIONS]
 
-def load_csv(csv_fname):
-    return pd.read_csv(csv_fname,
-                       dtype=SCHEMA,
-                       parse_dates=['date'],
-                       encoding='utf-8')
+# Number of rows read from the sorted runs (split between them), and written to the output, at a time.
+CHUNKSIZE = 10000
 
-def inner_sort(dfs):
-    for df in dfs:
-        assert all(~df['date'].isna())
-        df.sort_values('date', inplace=True)
+MANIFEST_SUFFIX = '.manifest.json'
 
-def outer_sort(dfs):
-    # If the first incident in one file took place earlier than the first incident in another,
-    # we assume all incidents in the former took place earlier than all incidents in the latter.
-    dfs.sort(key=lambda df: df.loc[0].date)
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '-o', '--output',
+        metavar='OUTFILE',
+        help="set output file (.csv, .parquet or .feather)",
+        dest='output_fname',
+        default='stage3.csv',
+    )
+    parser.add_argument(
+        '--chunksize',
+        help="number of rows read from the input files, split between them, and written at a time while merging",
+        type=int,
+        default=CHUNKSIZE,
+    )
+    parser.add_argument(
+        '--full',
+        help="rebuild the output from every stage 2 file, ignoring the manifest",
+        action='store_true',
+    )
+    return parser.parse_args()
+
+# —————
+# Manifest of the stage 2 files merged into the output
+
+def file_hash(fname):
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def load_manifest(output_fname):
+    """
+    :returns: the manifest written by the last run, or None if there is none or the output is gone
+    """
+    manifest_fname = output_fname + MANIFEST_SUFFIX
+    if not os.path.exists(manifest_fname) or not os.path.exists(output_fname):
+        return None
+    with open(manifest_fname) as f:
+        return json.load(f)
+
+def write_manifest(output_fname, shards):
+    dates = [(info['first_date'], info['last_date']) for info in shards.values() if info['rows']]
+    manifest = {
+        'output': output_fname,
+        'rows': sum(info['rows'] for info in shards.values()),
+        'first_date': min(first for first, _ in dates) if dates else None,
+        'last_date': max(last for _, last in dates) if dates else None,
+        'shards': shards,
+    }
+    with open(output_fname + MANIFEST_SUFFIX, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+def diff_shards(fnames, manifest):
+    """
+    Compares the stage 2 files on disk with the ones recorded in the manifest.
+    Files whose size and mtime changed are hashed to tell if their content really changed.
+    :returns: (unchanged, new, changed, removed) lists of file names
+    """
+    recorded = manifest['shards']
+    unchanged, new, changed = [], [], []
+    for fname in fnames:
+        info = recorded.get(fname)
+        if info is None:
+            new.append(fname)
+            continue
+        stat = os.stat(fname)
+        if stat.st_size == info['size'] and stat.st_mtime == info['mtime']:
+            unchanged.append(fname)
+        elif file_hash(fname) == info['sha1']:
+            info['size'], info['mtime'] = stat.st_size, stat.st_mtime
+            unchanged.append(fname)
+        else:
+            changed.append(fname)
+    removed = [fname for fname in recorded if fname not in fnames]
+    return unchanged, new, changed, removed
+
+# —————
+# Sorting and merging
+
+def sort_shard(fname, run_fname):
+    """
+    Sorts a stage 2 file by ascending date and writes the result to run_fname.
+    Only one shard is held in memory at a time.
+    :returns: the manifest entry of the shard
+    """
+    stat = os.stat(fname)
+    df = stage_io.read_stage(fname)
+    assert all(~df['date'].isna()), fname
+    df.sort_values('date', kind='mergesort', inplace=True)
+    stage_io.write_stage(df, run_fname)
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha1': file_hash(fname),
+        'rows': len(df),
+        'first_date': df['date'].iloc[0].isoformat() if len(df) else None,
+        'last_date': df['date'].iloc[-1].isoformat() if len(df) else None,
+    }
+
+def run_extension(output_fname):
+    """
+    Format of the sorted runs of an output. Runs of a columnar output are written as Parquet,
+    which keeps the floats that csv rounds, and can be read back in chunks.
+    """
+    return '.parquet' if stage_io.is_columnar(output_fname) else '.csv'
+
+def sort_shards(fnames, tmpdir, ext='.csv'):
+    """
+    Sorts each file on its own into tmpdir, as ext files.
+    :returns: (manifest entries by file name, sorted run file names ordered by their first date)
+    """
+    shards = {}
+    runs = []
+    for i, fname in enumerate(fnames):
+        run_fname = os.path.join(tmpdir, 'run{}{}'.format(i, ext))
+        shards[fname] = sort_shard(fname, run_fname)
+        if shards[fname]['rows']:
+            runs.append((shards[fname]['first_date'], i, run_fname))
+
+    # Incidents on the same date are ordered by the first date of their file.
+    runs.sort()
+    return shards, [run_fname for _, _, run_fname in runs]
+
+def iter_rows(run_fname, columns, chunksize):
+    """
+    Yields (date, row) pairs from a sorted run, reading chunksize rows at a time.
+    """
+    for chunk in stage_io.iter_stage(run_fname, chunksize):
+        chunk = chunk.reindex(columns=columns)
+        yield from zip(chunk['date'], chunk.itertuples(index=False, name=None))
+
+def merge_runs(run_fnames, output_fname, chunksize=CHUNKSIZE, append=False):
+    """
+    k-way merges files that are each sorted by date into output_fname, which is globally sorted
+    by date even if the date ranges of the files overlap. Incidents on the same date keep the
+    order of run_fnames, then their order within their file.
+    Each of the k files is read chunksize // k rows at a time, so memory use is bounded by about
+    2 * chunksize rows: the chunks being merged and the rows waiting to be written.
+    :param append: add the merged rows to the end of the existing (csv) output_fname
+    :returns: number of rows written
+    """
+    columns = list(next(stage_io.iter_stage(output_fname if append else run_fnames[0], 1)).columns)
+    for run_fname in run_fnames:
+        for column in next(stage_io.iter_stage(run_fname, 1)).columns:
+            if column not in columns:
+                assert not append, 'Column {} is not in {}'.format(column, output_fname)
+                columns.append(column)
+
+    run_chunksize = max(1, chunksize // len(run_fnames))
+    runs = [iter_rows(run_fname, columns, run_chunksize) for run_fname in run_fnames]
+
+    n_rows = 0
+    with stage_io.StageWriter(output_fname, append=append) as writer:
+        rows = []
+        for _, row in heapq.merge(*runs, key=lambda item: item[0]):
+            rows.append(row)
+            if len(rows) == chunksize:
+                writer.write(pd.DataFrame(rows, columns=columns))
+                n_rows += len(rows)
+                rows = []
+        if rows or (n_rows == 0 and not append):
+            writer.write(pd.DataFrame(rows, columns=columns))
+            n_rows += len(rows)
+    return n_rows
+
+# —————
+# Full and incremental builds
+
+def full_rebuild(fnames, output_fname, chunksize, tmpdir):
+    shards, runs = sort_shards(fnames, tmpdir, run_extension(output_fname))
+    if not runs:
+        print('No stage 2 incidents found')
+        return None
+
+    merge_runs(runs, output_fname, chunksize)
+    return shards
+
+def incremental_update(new_fnames, manifest, output_fname, chunksize, tmpdir):
+    """
+    Adds the incidents of new stage 2 files to an existing output.
+    If they all took place on or after the last incident of the output, they are appended to it
+    (for a csv output). Otherwise they are spliced in by merging them with the output, which is
+    already sorted and is never re-sorted.
+    """
+    shards, runs = sort_shards(new_fnames, tmpdir, run_extension(output_fname))
+    first_new = min((info['first_date'] for info in shards.values() if info['rows']), default=None)
+
+    if first_new is None:
+        print('New stage 2 files have no incidents')
+    elif manifest['last_date'] is not None and first_new >= manifest['last_date'] \
+            and not stage_io.is_columnar(output_fname):
+        print('Appending {} new stage 2 file(s)'.format(len(new_fnames)))
+        merge_runs(runs, output_fname, chunksize, append=True)
+    else:
+        print('Splicing {} new stage 2 file(s) into {}'.format(len(new_fnames), output_fname))
+        ext = os.path.splitext(output_fname)[1]
+        spliced_fname = os.path.join(tmpdir, 'spliced' + ext)
+        merge_runs([output_fname, *runs], spliced_fname, chunksize)
+        os.replace(spliced_fname, output_fname)
+
+    return {**manifest['shards'], **shards}
 
 def main():
-    # Sort the dataframes by ascending date, then sort by ascending date *within* each dataframe,
-    # then merge into 1 giant CSV.
-    dfs = [load_csv(fname) for fname in glob(STAGE2_GLOB)]
-    inner_sort(dfs)
-    outer_sort(dfs)
-
-    giant_df = pd.concat(dfs, ignore_index=True)
-    giant_df.to_csv('stage3.csv',
-                    index=False,
-                    float_format='%g',
-                    encoding='utf-8')
+    args = parse_args()
+
+    fnames = sorted(fname for pattern in STAGE2_GLOBS for fname in glob(pattern))
+    manifest = None if args.full else load_manifest(args.output_fname)
+
+    with TemporaryDirectory(dir=os.path.dirname(os.path.abspath(args.output_fname))) as tmpdir:
+        if manifest is None:
+            print('Rebuilding {} from {} stage 2 file(s)'.format(args.output_fname, len(fnames)))
+            shards = full_rebuild(fnames, args.output_fname, args.chunksize, tmpdir)
+        else:
+            unchanged, new, changed, removed = diff_shards(fnames, manifest)
+            if changed or removed:
+                # Rows of a changed or removed file cannot be taken out of the output.
+                print('{} stage 2 file(s) changed and {} were removed, rebuilding {}'.format(
+                    len(changed), len(removed), args.output_fname))
+                shards = full_rebuild(fnames, args.output_fname, args.chunksize, tmpdir)
+            elif new:
+                shards = incremental_update(new, manifest, args.output_fname, args.chunksize, tmpdir)
+            else:
+                print('{} is up to date'.format(args.output_fname))
+                shards = manifest['shards']
+
+    if shards is not None:
+        write_manifest(args.output_fname, shards)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# stage 4: decoding the participant and gun columns of stage 3 into tables of their own
+
+import os
+import pandas as pd
+
+from argparse import ArgumentParser
+
+import ingest
+import stage_io
+
+# Number of stage 3 rows decoded at a time.
+CHUNKSIZE = 100000
+
+TABLES = ['participants', 'guns']
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        'input_fname',
+        metavar='INFILE',
+        help="stage 3 file (.csv, .parquet or .feather, default: stage3.csv)",
+        nargs='?',
+        default='stage3.csv',
+    )
+    parser.add_argument(
+        '-o', '--output-dir',
+        help="directory of the participants.* and guns.* files (default: the current directory)",
+        default='.',
+    )
+    parser.add_argument(
+        '--format',
+        help="format of the output files (default: .parquet)",
+        choices=stage_io.EXTENSIONS,
+        default='.parquet',
+    )
+    parser.add_argument(
+        '--db',
+        help="also load the tables into this SQLite database (default: {})".format(ingest.DB_PATH),
+        default=ingest.DB_PATH,
+    )
+    parser.add_argument(
+        '--no-db',
+        help="only write the output files",
+        action='store_true',
+    )
+    parser.add_argument(
+        '--chunksize',
+        help="number of stage 3 rows decoded at a time (default: {})".format(CHUNKSIZE),
+        type=int,
+        default=CHUNKSIZE,
+    )
+    return parser.parse_args()
+
+def decode(fname, chunksize=CHUNKSIZE):
+    '''
+    Decodes the participant_* and gun_* columns of a stage 3 file.
+    :returns: (participants, guns) DataFrames, with one row per participant or gun
+    '''
+    participants, guns = [], []
+    for df in stage_io.iter_stage(fname, chunksize=chunksize):
+        participants.append(ingest.explode_participants(df))
+        guns.append(ingest.explode_guns(df))
+    return pd.concat(participants, ignore_index=True), pd.concat(guns, ignore_index=True)
+
+def load_db(conn, participants, guns):
+    ingest.recreate_table(conn, 'participants', ingest.PARTICIPANTS_SCHEMA)
+    ingest.bulk_insert(conn, 'participants', participants)
+    conn.execute(ingest.PARTICIPANTS_INDEX)
+
+    ingest.recreate_table(conn, 'guns', ingest.GUNS_SCHEMA)
+    ingest.bulk_insert(conn, 'guns', guns)
+    conn.execute(ingest.GUNS_INDEX)
+
+def main():
+    args = parse_args()
+
+    participants, guns = decode(args.input_fname, args.chunksize)
+    print("Decoded {} participants and {} guns".format(len(participants), len(guns)))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for name, table in zip(TABLES, [participants, guns]):
+        fname = os.path.join(args.output_dir, name + args.format)
+        stage_io.write_stage(table, fname)
+        print("Wrote {}".format(fname))
+
+    if not args.no_db:
+        load_db(ingest.connect(args.db), participants, guns)
+
+if __name__ == '__main__':
+    main()
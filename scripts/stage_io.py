@@ -0,0 +1,288 @@
+'''
+Reading and writing of the intermediate files produced by the scraping stages.
+
+Every stage can write its output either as csv or, when the output file name
+ends in .parquet or .feather, in a columnar format (requires pyarrow). The
+columnar files keep the dates typed and the state/city columns categorical,
+so loading them back needs no parsing.
+'''
+
+from os.path import splitext
+
+import numpy as np
+import pandas as pd
+
+# dtypes of the csv columns that pandas would otherwise guess wrong
+SCHEMA = {
+    'congressional_district': np.float64,
+    'state_house_district': np.float64,
+    'state_senate_district': np.float64,
+    'n_guns_involved': np.float64,
+}
+
+INT_COLUMNS = ['n_killed', 'n_injured']
+
+FLOAT_COLUMNS = ['latitude', 'longitude', *SCHEMA.keys()]
+
+DATE_COLUMNS = ['date']
+
+CATEGORICAL_COLUMNS = ['state', 'city_or_county']
+
+# dtypes of the numeric columns in load_incidents, e.g. the most injured in one incident is a few
+# hundred. The nullable dtypes are for the columns with missing values.
+COMPACT_DTYPES = {
+    'n_killed': 'int16',
+    'n_injured': 'int16',
+    'n_guns_involved': 'Int16',
+    'congressional_district': 'Int8',
+    'state_senate_district': 'Int8',
+    'state_house_district': 'Int16',
+    'latitude': 'float32',
+    'longitude': 'float32',
+}
+
+# Columns of '||' separated lists that load_incidents encodes as one boolean column per item
+MULTI_HOT_COLUMNS = ['incident_characteristics']
+
+CSV_EXTENSION = '.csv'
+COLUMNAR_EXTENSIONS = ['.parquet', '.feather']
+EXTENSIONS = [CSV_EXTENSION, *COLUMNAR_EXTENSIONS]
+
+
+def is_columnar(fname) -> bool:
+    return splitext(fname)[1] in COLUMNAR_EXTENSIONS
+
+
+def read_stage(fname, columns=None) -> pd.DataFrame:
+    '''
+    Loads the output of a stage.
+    :param columns: optional list of columns to load
+    '''
+    ext = splitext(fname)[1]
+    if ext == '.parquet':
+        return pd.read_parquet(fname, columns=columns)
+    if ext == '.feather':
+        return to_columnar_dtypes(pd.read_feather(fname, columns=columns))
+
+    return pd.read_csv(
+        fname,
+        usecols=columns,
+        dtype=SCHEMA,
+        parse_dates=[c for c in DATE_COLUMNS if columns is None or c in columns],
+        encoding='utf-8',
+    )
+
+
+def to_columnar_dtypes(df) -> pd.DataFrame:
+    '''
+    Converts the date columns to datetimes and the state/city columns to
+    categoricals.
+    '''
+    df = df.copy()
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col])
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+
+def multi_hot(s, sep='||') -> pd.DataFrame:
+    '''
+    Encodes a column of sep separated lists, e.g. 'Shot - Dead||Gang involvement', as one
+    boolean column per distinct item, named after it.
+    :returns: DataFrame with the index of s and the items as columns, in alphabetical order
+    '''
+    values = s.reset_index(drop=True).dropna().astype(str)
+    items = values.str.split(sep, regex=False).explode()
+    items = items[items != '']
+    codes, vocabulary = pd.factorize(items, sort=True)
+
+    mask = np.zeros((len(s), len(vocabulary)), dtype=bool)
+    mask[items.index.to_numpy(), codes] = True
+    return pd.DataFrame(mask, index=s.index, columns=list(vocabulary))
+
+
+def load_incidents(fname, columns=None, report=True) -> pd.DataFrame:
+    '''
+    Loads the output of stage 2 or 3 with compact dtypes: categorical state and city, the
+    COMPACT_DTYPES of the counts, districts and coordinates, and incident_characteristics as one
+    boolean column per characteristic, whose names are listed in
+    df.attrs['incident_characteristics'].
+
+    e.g. df = load_incidents('stage3.parquet')
+         df.groupby('state')[df.attrs['incident_characteristics']].sum()
+
+    :param columns: optional list of columns to load
+    :param report: print the memory used, and what the default dtypes of read_stage would use
+    '''
+    df = read_stage(fname, columns=columns)
+    n_bytes_before = df.memory_usage(deep=True).sum() if report else None
+
+    df = to_columnar_dtypes(df)
+    for col, dtype in COMPACT_DTYPES.items():
+        if col in df.columns:
+            df[col] = df[col].astype(dtype)
+
+    vocabularies = {}
+    for col in MULTI_HOT_COLUMNS:
+        if col in df.columns:
+            encoded = multi_hot(df.pop(col))
+            vocabularies[col] = list(encoded.columns)
+            df = pd.concat([df, encoded], axis=1)
+    df.attrs.update(vocabularies)
+
+    if report:
+        n_bytes = df.memory_usage(deep=True).sum()
+        print('Loaded {} incidents in {:.1f} MB ({:.1f} MB with the default dtypes)'.format(
+            len(df), n_bytes / 1024 ** 2, n_bytes_before / 1024 ** 2))
+    return df
+
+
+def write_stage(df, fname) -> None:
+    '''
+    Writes the output of a stage in the format given by the extension of fname.
+    '''
+    ext = splitext(fname)[1]
+    if ext == '.parquet':
+        to_columnar_dtypes(df).to_parquet(fname, index=False)
+    elif ext == '.feather':
+        to_columnar_dtypes(df).reset_index(drop=True).to_feather(fname)
+    else:
+        df.to_csv(
+            fname,
+            index=False,
+            float_format='%g',
+            encoding='utf-8',
+        )
+
+
+def iter_stage(fname, chunksize=10000):
+    '''
+    Loads the output of a stage in chunks of about chunksize rows.
+    :returns: generator of DataFrames
+    '''
+    ext = splitext(fname)[1]
+    if ext == '.parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(fname).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    elif ext == '.feather':
+        import pyarrow as pa
+        with pa.memory_map(fname) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i).to_pandas()
+    else:
+        yield from pd.read_csv(
+            fname,
+            dtype=SCHEMA,
+            parse_dates=DATE_COLUMNS,
+            encoding='utf-8',
+            chunksize=chunksize,
+        )
+
+
+def arrow_schema(columns, dictionary=True):
+    '''
+    Builds the pyarrow schema of a stage file with the given columns.
+    :param dictionary: whether to dictionary encode the categorical columns
+    '''
+    import pyarrow as pa
+
+    fields = []
+    for col in columns:
+        if col in DATE_COLUMNS:
+            typ = pa.timestamp('ns')
+        elif col in CATEGORICAL_COLUMNS and dictionary:
+            typ = pa.dictionary(pa.int32(), pa.string())
+        elif col in INT_COLUMNS:
+            typ = pa.int64()
+        elif col in FLOAT_COLUMNS:
+            typ = pa.float64()
+        else:
+            typ = pa.string()
+        fields.append(pa.field(col, typ))
+    return pa.schema(fields)
+
+
+def _to_arrow(df, schema):
+    import pyarrow as pa
+
+    arrays = []
+    for field in schema:
+        col = df[field.name]
+        if pa.types.is_string(field.type) or pa.types.is_dictionary(field.type):
+            values = col.astype(str).where(col.notna(), None)
+            array = pa.array(values, type=pa.string())
+            if pa.types.is_dictionary(field.type):
+                array = array.dictionary_encode()
+        elif pa.types.is_timestamp(field.type):
+            array = pa.array(pd.to_datetime(col), type=field.type, from_pandas=True)
+        else:
+            array = pa.array(col, type=field.type, from_pandas=True)
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+class StageWriter(object):
+    '''
+    Writes the output of a stage one chunk at a time, so that it never has to
+    be held in memory as a whole. Every chunk must have the same columns.
+
+    With append=True the chunks are added to the end of an existing csv file,
+    which must have the same columns. Columnar files cannot be appended to.
+    '''
+
+    def __init__(self, fname, append=False):
+        self._fname = fname
+        self._ext = splitext(fname)[1]
+        self._writer = None
+        self._schema = None
+        self._n_chunks = 0
+        if append:
+            assert self._ext not in COLUMNAR_EXTENSIONS, 'Cannot append to {}'.format(fname)
+            self._n_chunks = 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def write(self, df) -> None:
+        if self._ext in COLUMNAR_EXTENSIONS:
+            if self._writer is None:
+                # The arrow file format behind feather cannot change the dictionary of a
+                # column between chunks, so categoricals are restored by read_stage instead.
+                self._schema = arrow_schema(df.columns, dictionary=self._ext == '.parquet')
+                if self._ext == '.parquet':
+                    import pyarrow.parquet as pq
+                    self._writer = pq.ParquetWriter(self._fname, self._schema)
+                else:
+                    import pyarrow as pa
+                    self._writer = pa.ipc.new_file(self._fname, self._schema)
+            self._writer.write_table(_to_arrow(df, self._schema))
+        else:
+            df.to_csv(
+                self._fname,
+                mode='w' if self._n_chunks == 0 else 'a',
+                header=self._n_chunks == 0,
+                index=False,
+                float_format='%g',
+                encoding='utf-8',
+            )
+        self._n_chunks += 1
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def convert(src_fname, dst_fname) -> None:
+    '''
+    Rewrites a stage output in another format, e.g. csv to parquet.
+    '''
+    write_stage(read_stage(src_fname), dst_fname)
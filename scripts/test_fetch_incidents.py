@@ -0,0 +1,116 @@
+import asyncio
+import io
+import os
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stdout
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+import stage_io
+from d_stage2 import HTTP_RETRY_ON, fetch_incidents
+from metrics import Metrics
+from scheduler import Scheduler
+
+INCIDENT_PAGE = '''<html><body><div id="block-system-main">
+<div><h2>Location</h2><span>123 Main St</span><span>Springfield, Illinois</span><span>Geolocation: 39.78, -89.65</span></div>
+<div><h2>Participants</h2><ul><li>Type: Victim</li><li>Name: A</li></ul><ul><li>Type: Subject-Suspect</li></ul></div>
+<div><h2>Incident Characteristics</h2><ul><li>Shot - Wounded/Injured</li></ul></div>
+<div><h2>Notes</h2><p>note {id}</p></div>
+<div><h2>Guns Involved</h2><p>1 gun involved.</p><ul><li>Type: Handgun</li></ul></div>
+<div><h2>District</h2>Congressional District: 13<br>State Senate District: 48<br></div>
+</div></body></html>
+'''
+
+# Incident 2 has no page, so the server answers 404.
+INCIDENT_IDS = [1, 2, 3]
+SAVED_IDS = [1, 3]
+
+
+class RecordingHandler(SimpleHTTPRequestHandler):
+    paths = []
+
+    def do_GET(self):
+        self.paths.append(self.path)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestFetchIncidents(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        os.mkdir(os.path.join(self.tmpdir.name, 'incident'))
+        for incident_id in SAVED_IDS:
+            with open(os.path.join(self.tmpdir.name, 'incident', str(incident_id)), 'w') as f:
+                f.write(INCIDENT_PAGE.format(id=incident_id))
+
+        RecordingHandler.paths = []
+        handler = partial(RecordingHandler, directory=self.tmpdir.name)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+        self.df = pd.DataFrame({
+            'date': '2018-01-01',
+            'state': 'Illinois',
+            'city_or_county': 'Springfield',
+            'address': '123 Main St',
+            'n_killed': 0,
+            'n_injured': 1,
+            'incident_url': ['http://www.gunviolencearchive.org/incident/{}'.format(incident_id)
+                             for incident_id in INCIDENT_IDS],
+            'source_url': None,
+        })
+        self.checkpoint_fname = os.path.join(self.tmpdir.name, 's2.csv.part0.csv')
+
+    def fetch(self):
+        metrics = Metrics(fname=os.devnull)
+        out = io.StringIO()
+        with redirect_stdout(out):
+            df = asyncio.run(fetch_incidents(
+                self.df,
+                scheduler=Scheduler(0, retry_on=HTTP_RETRY_ON, max_retries=1),
+                base_url=self.base_url,
+                checkpoint_fname=self.checkpoint_fname,
+                flush_every=1,
+                cache=None,
+                metrics=metrics,
+            ))
+        return df, metrics, out.getvalue()
+
+    def test_fetch_incidents(self):
+        df, metrics, out = self.fetch()
+
+        self.assertEqual(list(df['incident_url']), list(self.df['incident_url'].iloc[[0, 2]]))
+        self.assertEqual(list(df['notes']), ['note 1', 'note 3'])
+        self.assertEqual(list(df['latitude']), [39.78, 39.78])
+        self.assertEqual(list(df['participant_type']), ['0::Victim||1::Subject-Suspect'] * 2)
+        self.assertEqual(list(df['gun_type']), ['0::Handgun'] * 2)
+
+        self.assertIn(self.df['incident_url'].iloc[1], out)
+        self.assertEqual(metrics.errors['ClientResponseError'], 1)
+        self.assertEqual(sorted(RecordingHandler.paths), ['/incident/1', '/incident/2', '/incident/3'])
+
+    def test_resume_skips_checkpointed_incidents(self):
+        self.fetch()
+        checkpoint = stage_io.read_stage(self.checkpoint_fname)
+        self.assertEqual(list(checkpoint['incident_url']), list(self.df['incident_url'].iloc[[0, 2]]))
+
+        RecordingHandler.paths = []
+        df, _, _ = self.fetch()
+        self.assertEqual(RecordingHandler.paths, ['/incident/2'])
+        self.assertEqual(list(df['incident_url']), list(self.df['incident_url'].iloc[[0, 2]]))
+        self.assertEqual(list(df['notes']), ['note 1', 'note 3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+
+import jobqueue
+from jobqueue import JobQueue
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.tmpdir.name, 'queue.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_queue(self, **kwargs):
+        queue = JobQueue(self.fname, **kwargs)
+        self.addCleanup(queue.close)
+        return queue
+
+    def test_expired_lease_is_claimed_again(self):
+        # A negative lease runs out as soon as the job is claimed.
+        queue = self.make_queue(lease_seconds=-1, max_attempts=3)
+        queue.add([('a', 1)])
+        self.assertEqual(queue.claim(), [('a', 1)])
+        self.assertEqual(queue.claim(), [('a', 1)])
+        self.assertEqual(queue.get('a'), (jobqueue.IN_FLIGHT, None))
+
+    def test_claim_fails_job_after_max_attempts(self):
+        queue = self.make_queue(lease_seconds=-1, max_attempts=2)
+        queue.add([('a', 1), ('b', 2)])
+        self.assertEqual(queue.claim(), [('a', 1)])
+        queue.done('a')
+        self.assertEqual(queue.claim(), [('b', 2)])
+        self.assertEqual(queue.claim(), [('b', 2)])
+
+        self.assertEqual(queue.claim(), [])
+        self.assertEqual(queue.get('b'), (jobqueue.FAILED, None))
+        error, = queue.conn.execute('SELECT error FROM jobs WHERE key = ?', ('b',)).fetchone()
+        self.assertEqual(error, 'lease expired 2 times')
+        self.assertTrue(queue.is_finished())
+
+    def test_unexpired_lease_is_not_failed(self):
+        queue = self.make_queue(max_attempts=1)
+        queue.add([('a', 1)])
+        self.assertEqual(queue.claim(), [('a', 1)])
+        self.assertEqual(queue.claim(), [])
+        self.assertEqual(queue.get('a'), (jobqueue.IN_FLIGHT, None))
+
+    def test_retry_failed_resets_attempts(self):
+        queue = self.make_queue(lease_seconds=-1, max_attempts=1)
+        queue.add([('a', 1)])
+        queue.claim()
+        self.assertEqual(queue.claim(), [])
+        self.assertEqual(queue.retry_failed(), 1)
+        self.assertEqual(queue.claim(), [('a', 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+import html_parsing
+from stage1_serializer import read_listing
+
+# A result page, latest incident first. The second row has an empty address cell.
+LISTING_PAGE = '''<html><body>
+<table class="responsive">
+<thead><tr><th>Incident ID</th><th>Date</th><th>State</th><th>City Or County</th><th>Address</th>
+<th># Killed</th><th># Injured</th><th>Operations</th></tr></thead>
+<tbody>
+<tr><td>3</td><td>January 2, 2018</td><td>Illinois</td><td>Chicago</td><td>1 State St</td><td>1</td><td>0</td>
+<td><ul><li><a href="/incident/3">View Incident</a></li><li><a href="http://example.com/3">View Source</a></li></ul></td></tr>
+<tr><td>2</td><td>January 1, 2018</td><td>Illinois</td><td>Springfield</td><td></td><td>0</td><td>2</td>
+<td><ul><li><a href="/incident/2">View Incident</a></li></ul></td></tr>
+</tbody>
+</table>
+</body></html>
+'''
+
+EXPECTED_ROWS = [
+    ('January 1, 2018', 'Illinois', 'Springfield', '', 0, 2,
+     'http://www.gunviolencearchive.org/incident/2', ''),
+    ('January 2, 2018', 'Illinois', 'Chicago', '1 State St', 1, 0,
+     'http://www.gunviolencearchive.org/incident/3', 'http://example.com/3'),
+]
+
+
+class TestReadListing(unittest.TestCase):
+
+    def test_backends_agree(self):
+        for backend in html_parsing.BACKENDS:
+            with self.subTest(backend=backend):
+                self.assertEqual(read_listing(LISTING_PAGE, backend), EXPECTED_ROWS)
+
+
+if __name__ == '__main__':
+    unittest.main()